@@ -0,0 +1,440 @@
+"""Benchmark offline di MusicNow.
+
+Esegue i veri handler del bot (/play, autocomplete, play_next, update_player_message)
+contro sostituti locali: un estrattore yt-dlp finto con latenza e fallimenti configurabili,
+un voice client finto che consuma i frame audio e un finto REST di Discord che conta le
+modifiche ai messaggi. Niente rete, niente token.
+
+Esempio:
+    python benchmark.py --guilds 300 --tracks 6 --latency 0.8 --failure-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+
+# Database usa e getta: le tracce finte non devono finire nel catalogo vero (né rendere
+# una run dipendente da quelle precedenti)
+SCRATCH = tempfile.TemporaryDirectory(prefix="musicnow-bench-")
+os.environ["STATE_DB"] = os.environ["CATALOG_DB"] = os.path.join(SCRATCH.name, "musicnow.db")
+
+import main
+
+FRAME = 0.02  # un frame Opus = 20 ms
+
+settings = SimpleNamespace(latency=0.5, failure_rate=0.0, cut_rate=0.0, track_seconds=12.0, frames_per_tick=10)
+
+
+# --- Statistiche ---
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.extractions = {}
+        self.failures = 0
+        self.gaps = []
+        self.autocomplete = []
+        self.autocomplete_empty = 0
+        self.loop_lag = []
+        self.edits = 0
+        self.sends = 0
+        self.deletes = 0
+        self.rate_limited = 0
+        self.tracks_started = 0
+        self.double_plays = 0
+        self.ffmpeg = 0
+
+    def extraction(self, kind):
+        with self.lock:
+            self.extractions[kind] = self.extractions.get(kind, 0) + 1
+
+stats = Stats()
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+# --- Finto yt-dlp ---
+class FakeYoutubeDL:
+    """Stessa interfaccia di yt_dlp.YoutubeDL per quello che usa il bot"""
+    def __init__(self, opts=None):
+        self.opts = opts or {}
+
+    def _wait(self):
+        time.sleep(max(0.0, random.gauss(settings.latency, settings.latency / 4)))
+
+    def _fail(self):
+        if random.random() < settings.failure_rate:
+            with stats.lock:
+                stats.failures += 1
+            return True
+        return False
+
+    @staticmethod
+    def _video(video_id, title):
+        expire = int(time.time()) + 6 * 3600
+        return {
+            'id': video_id,
+            'title': title,
+            'duration': settings.track_seconds,
+            'thumbnail': f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'url': f"https://fake.googlevideo.com/videoplayback?id={video_id}&expire={expire}&dur={settings.track_seconds}",
+            'acodec': 'opus',
+            'ext': 'webm',
+        }
+
+    def _playlist_entries(self, playlist_id, count):
+        for i in range(count):
+            if i % 100 == 0:
+                self._wait()  # una "pagina" della playlist
+            video_id = f"{playlist_id}-{i}"
+            yield {'_type': 'url', 'id': video_id, 'title': f"Brano {video_id}",
+                   'url': f"https://www.youtube.com/watch?v={video_id}", 'duration': settings.track_seconds}
+
+    def extract_info(self, query, download=False, process=True):
+        if query.startswith("ytsearch"):
+            stats.extraction('search')
+            self._wait()
+            text = query.split(":", 1)[1]
+            if self._fail():
+                return None
+            return {'entries': [
+                {'id': f"s{abs(hash((text, i))) % 10**8}", 'title': f"{text} risultato {i}"}
+                for i in range(5)
+            ]}
+        params = parse_qs(urlparse(query).query)
+        if 'list' in params:
+            stats.extraction('playlist')
+            self._wait()
+            count = int(params.get('n', ['20'])[0])
+            return {'_type': 'playlist', 'entries': self._playlist_entries(params['list'][0], count)}
+        stats.extraction('video')
+        self._wait()
+        if self._fail():
+            # Come yt-dlp senza ignoreerrors: errore di rete, da ritentare
+            raise main.load_yt_dlp().utils.DownloadError("ERROR: Unable to download webpage: timed out")
+        video_id = params.get('v', [query])[0]
+        return self._video(video_id, f"Brano {video_id}")
+
+
+# --- Finta sorgente audio e finto voice client ---
+class FakeSource:
+    def __init__(self, frames):
+        self.frames = frames
+
+    def read(self):
+        if self.frames <= 0:
+            return b''
+        self.frames -= 1
+        return b'\xf8\xff\xfe'
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.frames = 0
+
+def fake_audio_source(source, acodec=None, seek_time=0, local=False):
+    stats.ffmpeg += 1
+    seconds = float(parse_qs(urlparse(source).query).get('dur', [settings.track_seconds])[0])
+    frames = max(0, int((seconds - seek_time) / FRAME))
+    if random.random() < settings.cut_rate:
+        # Stream che cade a metà (URL scaduto, reconnect di FFmpeg fallito)
+        frames = int(frames * random.uniform(0.1, 0.6))
+    return FakeSource(frames)
+
+class FakeVoiceClient:
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self.connected = True
+        self.paused = False
+        self.task = None
+        self.last_end = None
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.task is not None and not self.paused
+
+    def is_paused(self):
+        return self.task is not None and self.paused
+
+    def play(self, source, after=None):
+        if self.task is not None:
+            stats.double_plays += 1
+            raise RuntimeError("Already playing audio.")
+        now = time.perf_counter()
+        if self.last_end is not None:
+            stats.gaps.append(now - self.last_end)
+        stats.tracks_started += 1
+        self.task = asyncio.create_task(self._consume(source, after))
+
+    async def _consume(self, source, after):
+        task = asyncio.current_task()
+        error = None
+        try:
+            while True:
+                if self.paused:
+                    await asyncio.sleep(FRAME)
+                    continue
+                data = b''
+                for _ in range(settings.frames_per_tick):
+                    data = source.read()
+                    if not data:
+                        break
+                if not data:
+                    break
+                await asyncio.sleep(FRAME * settings.frames_per_tick)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            error = e
+        finally:
+            source.cleanup()
+            if self.task is task:
+                self.task = None
+            self.last_end = time.perf_counter()
+            if after:
+                after(error)
+
+    def stop(self):
+        task, self.task = self.task, None
+        self.paused = False
+        if task:
+            task.cancel()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self.connected = False
+        self.guild.voice_client = None
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+
+# --- Finto REST di Discord ---
+class FakeMessage:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def edit(self, **kwargs):
+        self.channel.hit()
+        stats.edits += 1
+
+    async def delete(self):
+        stats.deletes += 1
+
+
+class FakeTextChannel:
+    # Bucket di Discord per le modifiche: 5 ogni 5 secondi per canale
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.calls = deque()
+
+    def hit(self):
+        now = time.monotonic()
+        while self.calls and now - self.calls[0] > 5:
+            self.calls.popleft()
+        self.calls.append(now)
+        if len(self.calls) > 5:
+            stats.rate_limited += 1
+
+    def permissions_for(self, member):
+        return SimpleNamespace(send_messages=True)
+
+    async def send(self, *args, **kwargs):
+        self.hit()
+        stats.sends += 1
+        return FakeMessage(self)
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id * 10 + 1
+
+    async def connect(self, **kwargs):
+        await asyncio.sleep(0.05)
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.me = SimpleNamespace(id=0)
+        self.voice_client = None
+        self.text_channels = [FakeTextChannel(guild_id * 10)]
+        self.voice_channel = FakeVoiceChannel(self)
+
+
+class FakeResponse:
+    async def defer(self, **kwargs):
+        pass
+
+    async def send_message(self, *args, **kwargs):
+        pass
+
+
+class FakeFollowup:
+    async def send(self, *args, **kwargs):
+        pass
+
+
+class FakeInteraction:
+    def __init__(self, guild, user_id):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = SimpleNamespace(id=user_id, voice=SimpleNamespace(channel=guild.voice_channel))
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+
+# --- Scenari ---
+POPULAR_QUERIES = [
+    "never gonna give you up", "bohemian rhapsody", "blinding lights", "despacito",
+    "shape of you", "bella ciao", "smells like teen spirit", "volare",
+]
+
+async def monitor_loop_lag(stop, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append(max(0.0, loop.time() - start - interval))
+
+async def run_guild(guild_id, args):
+    await asyncio.sleep(random.uniform(0, args.stagger))
+    guild = FakeGuild(guild_id)
+    interaction = FakeInteraction(guild, user_id=guild_id)
+    playlist = f"PL{guild_id % args.playlists}"
+    await main.play.callback(interaction, f"https://www.youtube.com/playlist?list={playlist}&n={args.tracks}")
+    guild_data = main.get_guild_data(guild_id)
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        if not guild_data['queue'] and guild_data['current_track'] is None:
+            break
+        await asyncio.sleep(0.2)
+
+async def run_typist(user_id, args):
+    await asyncio.sleep(random.uniform(0, args.stagger))
+    guild = FakeGuild(100000 + user_id)
+    interaction = FakeInteraction(guild, user_id=100000 + user_id)
+    query = random.choice(POPULAR_QUERIES)
+    pending = []
+
+    async def keystroke(text):
+        start = time.perf_counter()
+        choices = await main.ytsearch_autocomplete(interaction, text)
+        stats.autocomplete.append(time.perf_counter() - start)
+        if not choices:
+            stats.autocomplete_empty += 1
+
+    for i in range(3, len(query) + 1):
+        # Discord manda una richiesta per ogni tasto senza aspettare la precedente
+        pending.append(asyncio.create_task(keystroke(query[:i])))
+        await asyncio.sleep(random.uniform(0.08, 0.2))
+    await asyncio.gather(*pending)
+
+async def run(args):
+    main.load_yt_dlp().YoutubeDL = FakeYoutubeDL
+    main.make_audio_source = fake_audio_source
+    main.bot.loop = asyncio.get_running_loop()
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(monitor_loop_lag(stop))
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(run_guild(i + 1, args) for i in range(args.guilds)),
+        *(run_typist(u, args) for u in range(args.typists)),
+    )
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await lag_task
+
+    report = {
+        'guilds': args.guilds,
+        'elapsed_s': round(elapsed, 2),
+        'tracks_started': stats.tracks_started,
+        'extractions': stats.extractions,
+        'extraction_failures': stats.failures,
+        'track_cache': dict(main.track_cache.stats),
+        'gap_ms': {'p50': percentile(stats.gaps, 50) * 1000, 'p99': percentile(stats.gaps, 99) * 1000,
+                   'max': max(stats.gaps, default=0) * 1000},
+        'autocomplete_ms': {'p50': percentile(stats.autocomplete, 50) * 1000,
+                            'p99': percentile(stats.autocomplete, 99) * 1000,
+                            'empty': stats.autocomplete_empty, 'requests': len(stats.autocomplete)},
+        'loop_lag_ms': {'p50': percentile(stats.loop_lag, 50) * 1000, 'p99': percentile(stats.loop_lag, 99) * 1000,
+                        'max': max(stats.loop_lag, default=0) * 1000},
+        'messages': {'sends': stats.sends, 'edits': stats.edits, 'deletes': stats.deletes,
+                     'would_429': stats.rate_limited},
+        'double_plays': stats.double_plays,
+        'ffmpeg_processes': stats.ffmpeg,
+        'stream_resumes': sum(v for (name, _), v in main.metrics.counters.items() if name == 'musicnow_stream_resumes_total'),
+    }
+    for task in asyncio.all_tasks() - {asyncio.current_task()}:
+        task.cancel()
+    return report
+
+def print_report(report):
+    print(f"Guild simulate:        {report['guilds']}  ({report['elapsed_s']} s)")
+    print(f"Tracce avviate:        {report['tracks_started']}  (doppi play: {report['double_plays']}, riprese: {report['stream_resumes']})")
+    print(f"Processi FFmpeg:       {report['ffmpeg_processes']}")
+    print(f"Estrazioni:            {report['extractions']}  fallite: {report['extraction_failures']}")
+    print(f"Cache tracce:          {report['track_cache']}")
+    gap = report['gap_ms']
+    print(f"Gap tra tracce (ms):   p50 {gap['p50']:.1f}  p99 {gap['p99']:.1f}  max {gap['max']:.1f}")
+    ac = report['autocomplete_ms']
+    print(f"Autocomplete (ms):     p50 {ac['p50']:.1f}  p99 {ac['p99']:.1f}  vuote {ac['empty']}/{ac['requests']}")
+    lag = report['loop_lag_ms']
+    print(f"Lag event loop (ms):   p50 {lag['p50']:.1f}  p99 {lag['p99']:.1f}  max {lag['max']:.1f}")
+    msg = report['messages']
+    print(f"Messaggi:              invii {msg['sends']}  modifiche {msg['edits']}  cancellati {msg['deletes']}  429 simulati {msg['would_429']}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline del bot musicale")
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--tracks", type=int, default=5, help="tracce per playlist")
+    parser.add_argument("--playlists", type=int, default=20, help="playlist diverse (le altre guild le ripetono)")
+    parser.add_argument("--typists", type=int, default=50, help="utenti che scrivono nell'autocomplete")
+    parser.add_argument("--latency", type=float, default=0.5, help="latenza media di yt-dlp in secondi")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--cut-rate", type=float, default=0.0, help="probabilità che uno stream cada a metà")
+    # Sopra RESUME_MIN_REMAINING, altrimenti gli stream tagliati non vengono mai ripresi
+    parser.add_argument("--track-seconds", type=float, default=12.0)
+    parser.add_argument("--stagger", type=float, default=2.0, help="finestra di avvio delle guild in secondi")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="stampa il report in JSON")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    settings.latency = args.latency
+    settings.failure_rate = args.failure_rate
+    settings.cut_rate = args.cut_rate
+    settings.track_seconds = args.track_seconds
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
@@ -1,9 +1,33 @@
+import time
+STARTED_AT = time.monotonic()  # prima degli import: il tempo di avvio li comprende
+
 import discord
 from discord import app_commands, Interaction
 from discord.ext import commands
-import yt_dlp
 import asyncio
 import os
+import threading
+import sys
+import random
+import itertools
+import functools
+import json
+import hashlib
+import shutil
+import subprocess
+import logging
+import bisect
+import sqlite3
+import signal
+import argparse
+import csv
+import math
+import re
+import zlib
+from contextlib import aclosing, contextmanager
+from collections import OrderedDict, deque
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # --- Load env ---
@@ -15,96 +39,1481 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="", intents=intents)
-
-# --- YTDL / FFmpeg ---
-ytdl_opts = {
-    'format': 'bestaudio/best',
-    'quiet': True,
-    'no_warnings': True,
-    'ignoreerrors': True,
-    'geo_bypass': True,
-    'extract_flat': True,  # velocizza il caricamento playlist
-    'cookiefile': 'cookies.txt',
-    'noplaylist': False,
-    'default_search': 'auto'
-}
-ffmpeg_opts = {
-    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-    'options': '-vn',
+# --- Sharding ---
+# Impostate dal launcher (--shards) per ogni processo worker
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS", "").split(",") if i.strip()]
+# "1" = sincronizza gli slash command solo se sono cambiati, "force" = sempre, "0" = mai
+SYNC_COMMANDS = os.getenv("SYNC_COMMANDS", "1")
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix="", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None)
+else:
+    bot = commands.Bot(command_prefix="", intents=intents)
+
+# --- YTDL ---
+# yt-dlp pesa qualche centinaio di ms all'import: si carica al primo uso o nel warm-up dopo on_ready
+yt_dlp = None
+yt_dlp_lock = threading.Lock()
+
+def load_yt_dlp():
+    global yt_dlp
+    with yt_dlp_lock:
+        if yt_dlp is None:
+            import yt_dlp as module
+            yt_dlp = module
+    return yt_dlp
+
+# --- Metriche ---
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = endpoint disattivato
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+BACKSLASH, QUOTE = "\\", '"'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    """Contatori, gauge e istogrammi in formato testo Prometheus.
+
+    Aggiornabili da qualsiasi thread; i gauge "calcolati" vengono letti al momento dello scrape.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []  # funzioni che ritornano [(nome, tipo, labels, valore)]
+        self.help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0, 0.0]
+            index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+            if index < len(LATENCY_BUCKETS):
+                hist[0][index] += 1
+            hist[1] += 1
+            hist[2] += seconds
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """Misura una fase della pipeline in musicnow_stage_seconds{stage=...}"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('musicnow_stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        escaped = (f'{k}="{str(v).replace(BACKSLASH, BACKSLASH * 2).replace(QUOTE, BACKSLASH + QUOTE)}"' for k, v in labels)
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault((name, 'counter'), []).append((labels, value))
+            for (name, labels), value in self.gauges.items():
+                samples.setdefault((name, 'gauge'), []).append((labels, value))
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self.histograms.items()}
+        for fn in self.collectors:
+            try:
+                for name, kind, labels, value in fn():
+                    samples.setdefault((name, kind), []).append((tuple(sorted(labels.items())), value))
+            except Exception as e:
+                print(f"[Metrics] Errore nel collector {fn.__name__}: {e}")
+
+        lines = []
+        for (name, kind), values in sorted(samples.items()):
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{name}{self._labels(labels)} {value}" for labels, value in values)
+        by_name = {}
+        for (name, labels), hist in histograms.items():
+            by_name.setdefault(name, []).append((labels, hist))
+        for name, entries in sorted(by_name.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, (buckets, count, total) in entries:
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, buckets):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class RateLimitCounter(logging.Handler):
+    """discord.py gestisce i 429 da solo e li segnala solo nei log: qui li contiamo.
+
+    Ogni 429 produce "We are being rate limited..."; se è globale segue subito (senza await
+    in mezzo) "Global rate limit has been hit". Il conteggio si rimanda quindi al giro
+    successivo del loop, così lo stesso 429 finisce in un solo scope.
+    """
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.pending = None  # scope del 429 appena visto, non ancora contato
+
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith("Global rate limit has been hit"):
+            if self.pending is not None:
+                self.pending = 'global'
+            else:
+                metrics.inc('musicnow_rate_limited_total', scope='global')
+        elif message.startswith("We are being rate limited") and "Retrying" in message:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                metrics.inc('musicnow_rate_limited_total', scope='bucket')
+                return
+            if self.pending is None:
+                loop.call_soon(self._count)
+            self.pending = 'bucket'
+        elif message.startswith("We are being rate limited"):
+            # Attesa troppo lunga: discord.py rinuncia e non controlla se il limite è globale
+            metrics.inc('musicnow_rate_limited_total', scope='bucket')
+
+    def _count(self):
+        scope, self.pending = self.pending, None
+        if scope:
+            metrics.inc('musicnow_rate_limited_total', scope=scope)
+
+logging.getLogger('discord.http').addHandler(RateLimitCounter(level=logging.WARNING))
+
+# --- Resolver yt-dlp ---
+# Profili di opzioni: ogni worker tiene un'istanza YoutubeDL "calda" per profilo
+YTDL_PROFILES = {
+    # Preferisci Opus: può andare dritto a Discord senza ricodifica
+    # Niente ignoreerrors: gli errori devono arrivare per distinguere "non disponibile" da "riprova"
+    'stream': {'format': 'bestaudio[acodec=opus]/bestaudio/best', 'quiet': True, 'no_warnings': True, 'geo_bypass': True},
+    'search': {'quiet': True, 'extract_flat': True},
+    'flat': {'quiet': True, 'ignoreerrors': True, 'geo_bypass': True, 'extract_flat': 'in_playlist', 'noplaylist': False},
 }
-ytdl = yt_dlp.YoutubeDL(ytdl_opts)
+RESOLVER_WORKERS = int(os.getenv("RESOLVER_WORKERS", "4"))
+RESOLVER_PER_GUILD = int(os.getenv("RESOLVER_PER_GUILD", "2"))
+RESOLVER_TIMEOUT = float(os.getenv("RESOLVER_TIMEOUT", "20"))
+# Le playlist si enumerano in un pool a parte: molte pagine da scaricare non devono
+# bloccare gli stream, il prefetch e le ricerche delle altre guild
+RESOLVER_ENUM_WORKERS = int(os.getenv("RESOLVER_ENUM_WORKERS", "2"))
+# Stessa cosa per le ricerche di /bulk: decine di righe non tolgono worker alla riproduzione
+RESOLVER_BULK_WORKERS = int(os.getenv("RESOLVER_BULK_WORKERS", "4"))
+MAX_URL_REDIRECTS = 5
+
+def is_unavailable_error(error):
+    """True se yt-dlp segnala un video non riproducibile (privato, rimosso, bloccato),
+    False per gli errori che un nuovo tentativo può risolvere (rete, 5xx, timeout)"""
+    utils = load_yt_dlp().utils
+    if isinstance(error, utils.DownloadError) and error.exc_info:
+        error = error.exc_info[1]
+    return isinstance(error, utils.ExtractorError) and error.expected
+
+class StreamResolver:
+    """Esegue le estrazioni yt-dlp in un pool di thread limitato, fuori dall'event loop.
+
+    Ogni guild può occupare al massimo `per_guild` worker alla volta, così una
+    playlist enorme non affama le altre guild.
+    """
+    def __init__(self, workers=RESOLVER_WORKERS, per_guild=RESOLVER_PER_GUILD):
+        self.workers = workers
+        self.per_guild = per_guild
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="resolver")
+        self.slots = None
+        self.busy = 0
+        self.waiting = 0
+        self.guild_slots = {}
+        self.guild_pending = {}
+        self.local = threading.local()
+        self.enumerators = ThreadPoolExecutor(max_workers=RESOLVER_ENUM_WORKERS, thread_name_prefix="enumerate")
+        self.enum_slots = None
+        self.bulk = ThreadPoolExecutor(max_workers=RESOLVER_BULK_WORKERS, thread_name_prefix="bulk")
+        self.bulk_slots = None
+
+    def _ydl(self, profile):
+        ydls = getattr(self.local, 'ydls', None)
+        if ydls is None:
+            ydls = self.local.ydls = {}
+        ydl = ydls.get(profile)
+        if ydl is None:
+            ydl = ydls[profile] = load_yt_dlp().YoutubeDL(YTDL_PROFILES[profile])
+        return ydl
+
+    def _run(self, profile, query):
+        return self._ydl(profile).extract_info(query, download=False)
+
+    def _warm(self):
+        for profile in YTDL_PROFILES:
+            # Istanzia anche l'estrattore YouTube, che yt-dlp altrimenti carica alla prima estrazione
+            self._ydl(profile).get_info_extractor('Youtube')
+
+    async def warm_up(self):
+        """Importa yt-dlp e prepara le istanze dei worker, fuori dal percorso di avvio"""
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        await asyncio.gather(*(loop.run_in_executor(self.executor, self._warm) for _ in range(self.workers)))
+        print(f"🔥 yt-dlp pronto in {time.monotonic() - started:.2f}s")
+
+    def _guild_slot(self, guild_id):
+        if guild_id not in self.guild_slots:
+            self.guild_slots[guild_id] = asyncio.Semaphore(self.per_guild)
+        self.guild_pending[guild_id] = self.guild_pending.get(guild_id, 0) + 1
+        return self.guild_slots[guild_id]
+
+    def _release_guild(self, guild_id):
+        self.guild_pending[guild_id] -= 1
+        if not self.guild_pending[guild_id]:
+            del self.guild_pending[guild_id]
+            del self.guild_slots[guild_id]
+
+    async def _submit(self, fn, *args):
+        """Esegue `fn` nel pool; lo slot globale si libera solo quando il thread ha davvero
+        finito, anche se chi aspetta va in timeout o viene cancellato"""
+        loop = asyncio.get_running_loop()
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.workers)
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.busy += 1
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._done))
+        return future
+
+    def _done(self):
+        self.busy -= 1
+        self.slots.release()
+
+    async def extract(self, query, profile='stream', guild_id=None, timeout=RESOLVER_TIMEOUT):
+        """Ritorna l'info di yt-dlp per `query` (None se non disponibile)"""
+        guild_sem = self._guild_slot(guild_id)
+        try:
+            async with guild_sem:
+                future = await self._submit(self._run, profile, query)
+                try:
+                    with metrics.timer('extraction', profile=profile):
+                        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+                except asyncio.TimeoutError:
+                    metrics.inc('musicnow_extraction_timeouts_total', profile=profile)
+                    future.cancel()
+                    raise
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+        finally:
+            self._release_guild(guild_id)
+
+    async def extract_bulk(self, query, profile='search', timeout=RESOLVER_TIMEOUT):
+        """Come extract, ma nel pool di /bulk: non passa dagli slot globali né da quelli della guild"""
+        loop = asyncio.get_running_loop()
+        if self.bulk_slots is None:
+            self.bulk_slots = asyncio.Semaphore(RESOLVER_BULK_WORKERS)
+        await self.bulk_slots.acquire()
+        future = self.bulk.submit(self._run, profile, query)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.bulk_slots.release))
+        try:
+            with metrics.timer('extraction', profile=profile):
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            metrics.inc('musicnow_extraction_timeouts_total', profile=profile)
+            future.cancel()
+            raise
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    async def iter_entries(self, query, guild_id=None, timeout=RESOLVER_TIMEOUT):
+        """Enumera in modo flat le voci di un link o di una playlist man mano che
+        yt-dlp le scarica, senza risolvere i singoli brani"""
+        loop = asyncio.get_running_loop()
+        entries = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                info = self._ydl('flat').extract_info(query, download=False, process=False)
+                # process=False non segue i rimandi (es. youtu.be/ID?list=..., link di YouTube Music)
+                for _ in range(MAX_URL_REDIRECTS):
+                    if not info or info.get('_type') not in ('url', 'url_transparent'):
+                        break
+                    info = self._ydl('flat').extract_info(info['url'], download=False, process=False)
+                if not info:
+                    return
+                if info.get('_type') in ('playlist', 'multi_video'):
+                    # entries è un generatore: le pagine della playlist arrivano una alla volta
+                    for entry in info.get('entries') or []:
+                        if stop.is_set():
+                            break
+                        loop.call_soon_threadsafe(entries.put_nowait, entry)
+                elif info.get('_type') in ('url', 'url_transparent'):
+                    raise ValueError(f"troppi rimandi per {query}")
+                else:
+                    loop.call_soon_threadsafe(entries.put_nowait, info)
+            except Exception as e:
+                loop.call_soon_threadsafe(entries.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(entries.put_nowait, done)
+
+        if self.enum_slots is None:
+            self.enum_slots = asyncio.Semaphore(RESOLVER_ENUM_WORKERS)
+        await self.enum_slots.acquire()
+        future = self.enumerators.submit(produce)
+        # Lo slot torna libero solo quando il thread ha smesso di scaricare pagine
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.enum_slots.release))
+        try:
+            while True:
+                entry = await asyncio.wait_for(entries.get(), timeout)
+                if entry is done:
+                    return
+                if isinstance(entry, Exception):
+                    raise entry
+                yield entry
+        finally:
+            stop.set()
+            future.cancel()
+
+resolver = StreamResolver()
+
+# --- Tracce e coda ---
+_track_ids = itertools.count(1)
+
+class Track:
+    """Traccia in coda; l'ID è stabile e univoco, a differenza della posizione"""
+    __slots__ = ('id', 'title', 'url', 'thumbnail', 'duration')
+
+    def __init__(self, title, url, thumbnail=None, duration=None):
+        self.id = next(_track_ids)
+        # Le stesse canzoni girano in molte guild: condividi le stringhe
+        self.title = sys.intern(title)
+        self.url = sys.intern(url)
+        self.thumbnail = sys.intern(thumbnail) if thumbnail else None
+        self.duration = duration
+
+class TrackQueue:
+    """Coda di tracce con pop in testa, append e rimozione per ID in O(1).
+
+    `version` cambia a ogni modifica, così chi renderizza la coda può riusare il lavoro già fatto.
+    """
+    def __init__(self):
+        self.tracks = OrderedDict()  # track.id -> Track
+        self.version = 0
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __bool__(self):
+        return bool(self.tracks)
+
+    def __iter__(self):
+        return iter(self.tracks.values())
+
+    def _changed(self):
+        self.version += 1
+
+    def append(self, track):
+        self.tracks[track.id] = track
+        self._changed()
+
+    def insert_next(self, track):
+        self.tracks[track.id] = track
+        self.tracks.move_to_end(track.id, last=False)
+        self._changed()
+
+    def popleft(self):
+        _, track = self.tracks.popitem(last=False)
+        self._changed()
+        return track
+
+    def remove(self, track_id):
+        """Rimuove la traccia con quell'ID; None se era già stata tolta"""
+        track = self.tracks.pop(track_id, None)
+        if track is not None:
+            self._changed()
+        return track
+
+    def move(self, track_id, position):
+        if track_id not in self.tracks:
+            return False
+        if position <= 0:
+            self.tracks.move_to_end(track_id, last=False)
+        elif position >= len(self.tracks) - 1:
+            self.tracks.move_to_end(track_id)
+        else:
+            order = [t for t in self.tracks if t != track_id]
+            order.insert(position, track_id)
+            self.tracks = OrderedDict((t, self.tracks[t]) for t in order)
+        self._changed()
+        return True
+
+    def shuffle(self):
+        order = list(self.tracks.values())
+        random.shuffle(order)
+        self.tracks = OrderedDict((t.id, t) for t in order)
+        self._changed()
+
+    def clear(self):
+        self.tracks.clear()
+        self._changed()
+
+    def head(self, count):
+        return list(itertools.islice(self.tracks.values(), count))
+
+    def slice(self, start, stop):
+        return list(itertools.islice(self.tracks.values(), start, stop))
 
 # --- Queue per guild ---
 guild_states = {}
 active_queue_views = {}
 
 def get_guild_data(guild_id):
-    if guild_id not in guild_states:
-        guild_states[guild_id] = {
-            'queue': [],
+    guild_data = guild_states.get(guild_id)
+    if guild_data is None:
+        guild_data = guild_states[guild_id] = {
+            'queue': TrackQueue(),
+            'queue_page': 0,
+            'queue_pages': {},
             'current_track': None,
             'voice_client': None,
             'loop': False,
             'player_message': None,
+            'player_view': None,
+            'player_signature': None,
             'paused': False,
-            'elapsed': 0
+            'elapsed': 0,
+            'source': None,
+            'resume_at': None,
+            'prefetch_task': None,
+            'prefetch_dirty': False,
+            'last_active': 0
         }
-    return guild_states[guild_id]
+        guild_memory.restore(guild_id, guild_data)
+    guild_data['last_active'] = time.monotonic()
+    return guild_data
 
 # --- Modifica a QueueView per registrare l'istanza ---
 async def refresh_queue_embed(guild_id):
-    """Aggiorna l'embed della coda se c'è un menu aperto"""
+    """Aggiorna l'embed della coda se c'è un menu aperto (passando dal render coalescente)"""
     if guild_id in active_queue_views:
         view = active_queue_views[guild_id]
-        await view.update_embed()
+        render_scheduler.mark_dirty(('queue', guild_id), QueueView.update_embed, view)
 
 def get_queue(guild_id):
     return get_guild_data(guild_id)['queue']
 
-# --- YouTube API search ---
+QUEUE_LIMIT = int(os.getenv("QUEUE_LIMIT", "5000"))
+UNAVAILABLE_TITLES = ('[Deleted video]', '[Private video]')
+
+def entry_thumbnail(entry):
+    """Le voci flat non hanno 'thumbnail' ma solo la lista 'thumbnails'"""
+    if entry.get('thumbnail'):
+        return entry['thumbnail']
+    thumbnails = entry.get('thumbnails') or []
+    return thumbnails[-1].get('url') if thumbnails else None
+
+# --- Cache condivisa degli stream risolti ---
+STREAM_EXPIRY_MARGIN = 300  # secondi prima della scadenza in cui un URL va rinnovato
+TRACK_CACHE_SIZE = int(os.getenv("TRACK_CACHE_SIZE", "2000"))
+TRACK_CACHE_TTL = 3600  # per gli URL senza expire=
+# Campi di yt-dlp che servono davvero: il resto (formats, ecc.) pesa solo in memoria
+TRACK_INFO_FIELDS = ('id', 'title', 'thumbnail', 'duration', 'url', 'webpage_url', 'acodec', 'ext', 'abr', 'asr')
+
+def stream_expiry(stream_url):
+    """Legge il parametro expire= degli URL googlevideo (None se assente)"""
+    try:
+        return float(parse_qs(urlparse(stream_url).query)['expire'][0])
+    except (KeyError, ValueError, IndexError):
+        return None
 
-async def search_youtube_yt_dlp(query: str):
-    """Cerca su YouTube senza API key usando yt-dlp e ritorna Choice già pronti"""
-    loop = asyncio.get_event_loop()
+def video_id_from_url(url):
+    """Estrae l'ID del video dai link YouTube; per gli altri link usa l'URL stesso"""
+    parsed = urlparse(url)
+    host = parsed.netloc.lower()
+    if host.endswith("youtu.be"):
+        return parsed.path.lstrip("/") or url
+    if "youtube" in host:
+        video_id = parse_qs(parsed.query).get('v')
+        if video_id:
+            return video_id[0]
+        if parsed.path.startswith(("/shorts/", "/live/")):
+            return parsed.path.split("/")[2]
+    return url
+
+class TrackCache:
+    """Cache LRU limitata, chiave = ID video, che rispetta la scadenza degli URL di stream.
+
+    Le richieste concorrenti per lo stesso ID condividono un'unica estrazione.
+    """
+    def __init__(self, max_size=TRACK_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # video_id -> (scadenza, info)
+        self.in_flight = {}
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'coalesced': 0}
+
+    def get(self, video_id):
+        entry = self.entries.get(video_id)
+        if entry is None:
+            return None
+        deadline, info = entry
+        if deadline <= time.time():
+            del self.entries[video_id]
+            self.stats['expired'] += 1
+            return None
+        self.entries.move_to_end(video_id)
+        return info
+
+    def put(self, video_id, info):
+        info = {k: info[k] for k in TRACK_INFO_FIELDS if info.get(k) is not None}
+        expire = stream_expiry(info['url'])
+        deadline = expire - STREAM_EXPIRY_MARGIN if expire else time.time() + TRACK_CACHE_TTL
+        self.entries[video_id] = (deadline, info)
+        self.entries.move_to_end(video_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+        return info
+
+    def invalidate(self, video_id, url=None):
+        """Scarta l'info in cache; con `url` solo se è ancora quella (un'altra guild potrebbe averla già rinnovata)"""
+        entry = self.entries.get(video_id)
+        if entry is not None and (url is None or entry[1].get('url') == url):
+            del self.entries[video_id]
+
+    async def resolve(self, url, guild_id=None):
+        video_id = video_id_from_url(url)
+        info = self.get(video_id)
+        if info is not None:
+            self.stats['hits'] += 1
+            return info
+        pending = self.in_flight.get(video_id)
+        if pending is not None:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(pending)
+        self.stats['misses'] += 1
+        pending = self.in_flight[video_id] = asyncio.get_running_loop().create_future()
+        try:
+            info = await resolver.extract(url, guild_id=guild_id)
+            if info and 'url' in info:
+                info = self.put(video_id, info)
+            else:
+                info = None
+            pending.set_result(info)
+            return info
+        except asyncio.CancelledError:
+            pending.cancel()
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            # Evita il warning "exception was never retrieved" se nessuno aspettava
+            pending.exception()
+            raise
+        finally:
+            del self.in_flight[video_id]
+
+track_cache = TrackCache()
+
+async def resolve_stream(url, guild_id=None):
+    """Info dello stream per `url` (None se non disponibile), passando dalla cache"""
+    return await track_cache.resolve(url, guild_id)
+
+# --- Prefetch delle prossime tracce ---
+PREFETCH_AHEAD = int(os.getenv("PREFETCH_AHEAD", "2"))
+
+def schedule_prefetch(guild_id):
+    """Avvia (o riaccoda) la risoluzione in background delle prossime tracce"""
+    guild_data = get_guild_data(guild_id)
+    task = guild_data['prefetch_task']
+    if task and not task.done():
+        guild_data['prefetch_dirty'] = True
+        return
+    guild_data['prefetch_task'] = asyncio.create_task(prefetch_queue(guild_id))
+
+async def prefetch_queue(guild_id):
+    """Scalda la cache per le prossime tracce; rinnova anche gli URL vicini alla scadenza"""
+    guild_data = get_guild_data(guild_id)
+    guild_data['prefetch_dirty'] = True
+    while guild_data['prefetch_dirty']:
+        guild_data['prefetch_dirty'] = False
+        for track in guild_data['queue'].head(PREFETCH_AHEAD):
+            try:
+                await resolve_stream(track.url, guild_id)
+            except Exception as e:
+                print(f"[Music] Prefetch fallito per {track.url}: {e}")
+
+# --- Posizione di riproduzione ---
+OPUS_FRAME_SECONDS = 0.02
+
+class TrackedSource(discord.AudioSource):
+    """Avvolge la sorgente FFmpeg e conta i frame davvero inviati a Discord"""
+    def __init__(self, inner, start=0):
+        self.inner = inner
+        self.start = start
+        self.frames = 0
+
+    @property
+    def position(self):
+        return self.start + self.frames * OPUS_FRAME_SECONDS
+
+    def read(self):
+        data = self.inner.read()
+        if data:
+            self.frames += 1
+        return data
+
+    def is_opus(self):
+        return self.inner.is_opus()
+
+    def cleanup(self):
+        self.inner.cleanup()
+
+def playback_position(guild_data):
+    """Secondi della traccia corrente già suonati, contati dai frame inviati"""
+    if guild_data['current_track'] is None:
+        return 0
+    if guild_data['source'] is not None:
+        return guild_data['source'].position
+    return guild_data['elapsed']
+
+def set_paused(guild_id, paused):
+    guild_data = get_guild_data(guild_id)
+    guild_data['paused'] = paused
+    state_store.mark_dirty(guild_id)
+    if guild_id in players:
+        players[guild_id].set_paused(paused)
+
+# --- Sorgenti condivise tra guild ---
+SHARED_STREAMS_ENABLED = os.getenv("SHARED_STREAMS", "1") == "1"
+SHARED_BUFFER_SECONDS = 15.0  # quanto indietro può agganciarsi una guild arrivata dopo
+SHARED_BUFFER_FRAMES = int(SHARED_BUFFER_SECONDS / OPUS_FRAME_SECONDS)
+# Scarto accettato tra la posizione chiesta e quella disponibile: le guild che ripartono
+# insieme dopo la caduta di uno stream non sono mai allineate al frame
+SHARED_JOIN_TOLERANCE_FRAMES = int(0.5 / OPUS_FRAME_SECONDS)
+
+class SharedPipeline:
+    """Un solo FFmpeg per traccia: i frame Opus finiscono in un buffer circolare letto da più guild.
+
+    Non c'è un thread produttore: il lettore più avanti estrae il frame successivo da FFmpeg,
+    gli altri lo ritrovano nel buffer.
+    """
+    def __init__(self, key, inner, start, reopen, url=None):
+        self.key = key
+        self.inner = inner
+        self.start = start
+        self.reopen = reopen  # seek_time -> nuova sorgente, per chi resta indietro
+        self.url = url        # URL dello stream (o file) letto da FFmpeg
+        self.frames = deque(maxlen=SHARED_BUFFER_FRAMES)
+        self.produced = 0     # frame letti da FFmpeg finora
+        self.finished = False
+        self.readers = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base(self):
+        """Indice del frame più vecchio ancora nel buffer"""
+        return self.produced - len(self.frames)
+
+    def frame_at(self, seconds):
+        return round((seconds - self.start) / OPUS_FRAME_SECONDS)
+
+    def read(self, index):
+        """Il frame `index`; b'' a fine traccia, None se è già uscito dal buffer"""
+        with self.lock:
+            if index < self.base:
+                return None
+            if index < self.produced:
+                return self.frames[index - self.base]
+            if self.finished:
+                return b''
+            data = self.inner.read()
+            if not data:
+                self.finished = True
+                return b''
+            self.frames.append(data)
+            self.produced += 1
+            return data
+
+class SharedReader(discord.AudioSource):
+    """Il punto di ascolto di una guild su una SharedPipeline"""
+    def __init__(self, pipeline, index):
+        self.pipeline = pipeline
+        self.index = index
+        self.own = None  # sorgente privata se si è rimasti troppo indietro (es. pausa lunga)
+
+    def read(self):
+        if self.own is not None:
+            return self.own.read()
+        data = self.pipeline.read(self.index)
+        if data is None:
+            position = self.pipeline.start + self.index * OPUS_FRAME_SECONDS
+            self.own = self.pipeline.reopen(position)
+            shared_streams.release(self.pipeline)
+            metrics.inc('musicnow_shared_stream_detaches_total')
+            return self.own.read()
+        if data:
+            self.index += 1
+        return data
+
+    def is_opus(self):
+        return True
 
-    def extract():
-        with yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': True}) as ydl:
-            return ydl.extract_info(f"ytsearch5:{query}", download=False)
+    def cleanup(self):
+        if self.own is not None:
+            self.own.cleanup()
+        elif self.pipeline is not None:
+            shared_streams.release(self.pipeline)
+        self.pipeline = None
+
+class SharedStreams:
+    """Registro delle pipeline attive, con conteggio dei lettori"""
+    def __init__(self):
+        self.pipelines = {}  # video_id -> [SharedPipeline]
+        self.lock = threading.Lock()
+
+    def attach(self, video_id, seek_time):
+        """Un lettore su una pipeline che ha ancora in buffer `seek_time`, altrimenti None"""
+        with self.lock:
+            for pipeline in self.pipelines.get(video_id, ()):
+                if pipeline.finished or pipeline.readers == 0:
+                    continue
+                index = pipeline.frame_at(seek_time)
+                if pipeline.base - SHARED_JOIN_TOLERANCE_FRAMES <= index <= pipeline.produced + SHARED_JOIN_TOLERANCE_FRAMES:
+                    index = min(max(index, pipeline.base), pipeline.produced)
+                    pipeline.readers += 1
+                    metrics.inc('musicnow_shared_stream_attaches_total')
+                    return SharedReader(pipeline, index)
+        return None
 
-    info = await loop.run_in_executor(None, extract)
-    results = []
+    def publish(self, video_id, inner, seek_time, reopen, url=None):
+        """Registra una nuova pipeline e restituisce il primo lettore"""
+        pipeline = SharedPipeline(video_id, inner, seek_time, reopen, url)
+        pipeline.readers = 1
+        with self.lock:
+            self.pipelines.setdefault(video_id, []).append(pipeline)
+        return SharedReader(pipeline, 0)
+
+    def release(self, pipeline):
+        with self.lock:
+            pipeline.readers -= 1
+            if pipeline.readers > 0:
+                return
+            group = self.pipelines.get(pipeline.key, [])
+            if pipeline in group:
+                group.remove(pipeline)
+            if not group:
+                self.pipelines.pop(pipeline.key, None)
+        pipeline.inner.cleanup()
+
+    def stats(self):
+        with self.lock:
+            groups = [p for group in self.pipelines.values() for p in group]
+            return len(groups), sum(p.readers for p in groups)
+
+shared_streams = SharedStreams()
+
+# --- Stato persistente delle guild ---
+STATE_DB = os.getenv("STATE_DB", "musicnow.db")
+STATE_FLUSH_INTERVAL = 2.0       # le modifiche vengono scritte a blocchi, mai sul percorso caldo
+STATE_DB_TIMEOUT = 10.0          # secondi di attesa se un altro processo tiene il lock di scrittura
+STATE_POSITION_INTERVAL = 15.0   # ogni quanto salvare la posizione delle guild che suonano
+RESTORE_CONCURRENCY = int(os.getenv("RESTORE_CONCURRENCY", "5"))
+RESTORE_STAGGER = 0.25
+
+def track_to_row(track):
+    return [track.title, track.url, track.thumbnail, track.duration]
+
+def track_from_row(row):
+    return Track(*row)
+
+class StateStore:
+    """Salva lo stato delle guild in SQLite (WAL) con scrittura differita.
+
+    Il loop segna solo le guild "sporche"; un task le serializza ogni STATE_FLUSH_INTERVAL
+    e un thread dedicato le scrive in un'unica transazione.
+    """
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self.dirty = set()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-store")
+        self.conn = None
+        self.task = None
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=STATE_DB_TIMEOUT, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS guild_state ("
+                "guild_id INTEGER PRIMARY KEY, voice_channel_id INTEGER, text_channel_id INTEGER, "
+                "loop INTEGER, paused INTEGER, elapsed REAL, current_track TEXT, queue TEXT, updated REAL)"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        return self.conn
+
+    def mark_dirty(self, guild_id):
+        self.dirty.add(guild_id)
+
+    def snapshot(self, guild_id):
+        """Riga da salvare per la guild, o None se non c'è nulla da ricordare"""
+        guild_data = guild_states.get(guild_id)
+        if not guild_data or (guild_data['current_track'] is None and not guild_data['queue']):
+            return None
+        vc = guild_data['voice_client']
+        message = guild_data['player_message']
+        current = guild_data['current_track']
+        return (
+            guild_id,
+            vc.channel.id if vc and vc.is_connected() else None,
+            message.channel.id if message else None,
+            int(guild_data['loop']),
+            int(guild_data['paused']),
+            playback_position(guild_data),
+            json.dumps(track_to_row(current)) if current else None,
+            json.dumps([track_to_row(t) for t in guild_data['queue']]),
+            time.time(),
+        )
+
+    def _write(self, rows, deleted, positions=()):
+        conn = self._connect()
+        with conn:
+            if rows:
+                conn.executemany("INSERT OR REPLACE INTO guild_state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            if deleted:
+                conn.executemany("DELETE FROM guild_state WHERE guild_id = ?", [(g,) for g in deleted])
+            if positions:
+                conn.executemany("UPDATE guild_state SET elapsed = ?, updated = ? WHERE guild_id = ?", positions)
+
+    def _load(self):
+        conn = self._connect()
+        return conn.execute("SELECT * FROM guild_state").fetchall()
+
+    async def flush(self, positions=False):
+        """Scrive le guild sporche; con `positions` aggiorna anche solo la posizione di quelle che suonano"""
+        moving = []
+        if positions:
+            # Solo la posizione cambia: niente snapshot (e JSON della coda) per chi non è sporco
+            now = time.time()
+            moving = [
+                (playback_position(d), now, g) for g, d in guild_states.items()
+                if d['current_track'] is not None and g not in self.dirty
+            ]
+        if not self.dirty and not moving:
+            return
+        dirty, self.dirty = self.dirty, set()
+        rows, deleted = [], []
+        for guild_id in dirty:
+            if guild_memory.is_compacted(guild_id):
+                continue  # la riga salvata prima della compattazione è ancora quella giusta
+            row = self.snapshot(guild_id)
+            if row is None:
+                deleted.append(guild_id)
+            else:
+                rows.append(row)
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.writer, self._write, rows, deleted, moving)
+        except Exception:
+            # Es. "database is locked" con più worker sullo stesso file: si riprova al giro dopo
+            self.dirty |= dirty
+            raise
+
+    async def run(self):
+        last_positions = time.monotonic()
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            positions = time.monotonic() - last_positions >= STATE_POSITION_INTERVAL
+            if positions:
+                last_positions = time.monotonic()
+            try:
+                await self.flush(positions)
+            except Exception as e:
+                print(f"[State] Errore salvando lo stato: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def load(self):
+        return await asyncio.get_running_loop().run_in_executor(self.writer, self._load)
+
+    def _get_meta(self, key):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    async def get_meta(self, key):
+        return await asyncio.get_running_loop().run_in_executor(self.writer, self._get_meta, key)
+
+    async def set_meta(self, key, value):
+        await asyncio.get_running_loop().run_in_executor(self.writer, self._set_meta, key, value)
+
+state_store = StateStore()
+
+async def restore_guild(row, slots):
+    guild_id, voice_channel_id, _, loop_flag, paused, elapsed, current, queue, _ = row
+    guild = bot.get_guild(guild_id)
+    if guild is None:
+        return
+    guild_data = get_guild_data(guild_id)
+    if guild_data['current_track'] is not None or guild_data['queue']:
+        return  # qualcuno ha già usato /play nel frattempo
+    for track_row in json.loads(queue or "[]"):
+        guild_data['queue'].append(track_from_row(track_row))
+    guild_data['loop'] = bool(loop_flag)
+    channel = guild.get_channel(voice_channel_id) if voice_channel_id else None
+    if current:
+        guild_data['queue'].insert_next(track_from_row(json.loads(current)))
+    if channel is None or not guild_data['queue']:
+        state_store.mark_dirty(guild_id)
+        return
+    async with slots:
+        vc = await ensure_vc_connected(guild, channel)
+        if vc is None:
+            return
+        await play_next(guild, vc, seek_time=elapsed if current else 0)
+        if paused and vc.is_playing():
+            vc.pause()
+            set_paused(guild_id, True)
+        # Distanzia le ripartenze per non saturare il resolver
+        await asyncio.sleep(RESTORE_STAGGER)
+
+async def restore_state():
+    """Ripristina le guild salvate: rientra nei canali vocali e riprende dalla posizione salvata"""
+    try:
+        rows = await state_store.load()
+    except Exception as e:
+        print(f"[State] Impossibile leggere lo stato salvato: {e}")
+        return
+    slots = asyncio.Semaphore(RESTORE_CONCURRENCY)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(restore_guild(row, slots) for row in rows), return_exceptions=True)
+    for row, result in zip(rows, results):
+        if isinstance(result, Exception):
+            print(f"[State] Ripristino fallito per la guild {row[0]}: {result}")
+    print(f"♻️ Stato di {len(rows)} guild ripristinato in {time.perf_counter() - started:.1f}s")
+
+# --- Cache audio locale su disco ---
+AUDIO_CACHE_ENABLED = os.getenv("AUDIO_CACHE", "0") == "1"
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "audio_cache")
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_MB", "2048")) * 1024 * 1024
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3"))
+AUDIO_CACHE_POLICY = os.getenv("AUDIO_CACHE_POLICY", "lfu")  # "lfu" oppure "lru"
+AUDIO_CACHE_MAX_COUNTERS = 20000  # quante tracce non in cache tenere nel conteggio ascolti
+AUDIO_CACHE_SAVE_DELAY = 10
+
+AUDIO_CACHE_FILE = re.compile(r"[0-9a-f]{40}\.opus(\.part)?")  # nomi di file_name() e dei download parziali
+
+class AudioCache:
+    """Salva su disco in Opus le tracce più ascoltate e le serve senza estrazione né rete.
+
+    L'indice (ascolti, ultimo accesso, dimensione) sta in index.json e sopravvive ai riavvii.
+    La sorgente da salvare può essere un URL di stream o un file locale.
+    """
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES,
+                 min_plays=AUDIO_CACHE_MIN_PLAYS, policy=AUDIO_CACHE_POLICY):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.policy = policy
+        self.index_path = os.path.join(directory, "index.json")
+        self.entries = {}  # video_id -> {'plays', 'last', 'size', 'file'}
+        self.writing = set()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio-cache")
+        self.save_handle = None
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        # Riallinea l'indice con i file davvero presenti
+        for entry in self.entries.values():
+            if entry.get('file') and not os.path.isfile(os.path.join(self.directory, entry['file'])):
+                entry['file'] = None
+                entry['size'] = 0
+        known = {e['file'] for e in self.entries.values() if e.get('file')}
+        # Si cancellano solo i file che crea la cache: se la cartella è sbagliata (".", la home)
+        # il resto non va toccato
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if AUDIO_CACHE_FILE.fullmatch(name) and name not in known and os.path.isfile(path):
+                os.remove(path)
+
+    def _save(self, data=None):
+        if data is None:
+            data = json.dumps(self.entries)
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, self.index_path)
+
+    def _schedule_save(self):
+        if self.save_handle is None:
+            loop = asyncio.get_running_loop()
+            self.save_handle = loop.call_later(AUDIO_CACHE_SAVE_DELAY, self._flush)
+
+    def _flush(self):
+        self.save_handle = None
+        # Serializza nel loop: l'indice cambia solo lì, il thread scrive solo i byte
+        self.writer.submit(self._save, json.dumps(self.entries))
+
+    @staticmethod
+    def file_name(video_id):
+        return hashlib.sha1(video_id.encode()).hexdigest() + ".opus"
+
+    def cached_bytes(self):
+        return sum(e.get('size', 0) for e in self.entries.values())
+
+    def lookup(self, video_id):
+        """Percorso del file in cache (None se non c'è); conta anche l'ascolto"""
+        entry = self.entries.get(video_id)
+        if not entry or not entry.get('file'):
+            return None
+        path = os.path.join(self.directory, entry['file'])
+        if not os.path.isfile(path):
+            entry['file'] = None
+            entry['size'] = 0
+            return None
+        entry['plays'] += 1
+        entry['last'] = time.time()
+        self._schedule_save()
+        return path
+
+    def record_play(self, video_id, source, acodec=None):
+        """Conta un ascolto non servito dalla cache; oltre la soglia salva la traccia in background"""
+        entry = self.entries.setdefault(video_id, {'plays': 0, 'last': 0, 'size': 0, 'file': None})
+        entry['plays'] += 1
+        entry['last'] = time.time()
+        self._prune_counters()
+        self._schedule_save()
+        if entry['plays'] >= self.min_plays and video_id not in self.writing:
+            self.writing.add(video_id)
+            loop = asyncio.get_running_loop()
+            future = self.writer.submit(self._write, video_id, source, acodec)
+            future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._written, video_id, f))
+
+    def store_file(self, video_id, path):
+        """Copia un file audio locale in cache (utile senza YouTube, ad esempio nei test)"""
+        name = self.file_name(video_id)
+        shutil.copyfile(path, os.path.join(self.directory, name))
+        entry = self.entries.setdefault(video_id, {'plays': 0, 'last': 0, 'size': 0, 'file': None})
+        entry.update(file=name, size=os.path.getsize(path), last=time.time())
+        self._evict()
+        self._save()
+
+    def _write(self, video_id, source, acodec):
+        name = self.file_name(video_id)
+        final = os.path.join(self.directory, name)
+        tmp = final + ".part"
+        # Se lo stream è già Opus basta rimuxarlo, altrimenti si codifica
+        codec = ['-c:a', 'copy'] if acodec == 'opus' else ['-c:a', 'libopus', '-b:a', '128k']
+        cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', source, '-vn', *codec, '-f', 'opus', tmp]
+        try:
+            subprocess.run(cmd, check=True, timeout=900, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            os.replace(tmp, final)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return name, os.path.getsize(final)
+
+    def _written(self, video_id, future):
+        self.writing.discard(video_id)
+        try:
+            name, size = future.result()
+        except Exception as e:
+            print(f"[Music] Cache audio fallita per {video_id}: {e}")
+            return
+        entry = self.entries.setdefault(video_id, {'plays': 0, 'last': 0, 'size': 0, 'file': None})
+        entry.update(file=name, size=size)
+        self._evict()
+        self._schedule_save()
+
+    def _eviction_key(self, item):
+        _, entry = item
+        if self.policy == "lru":
+            return entry['last']
+        return (entry['plays'], entry['last'])
+
+    def _evict(self):
+        total = self.cached_bytes()
+        if total <= self.max_bytes:
+            return
+        for video_id, entry in sorted(((k, e) for k, e in self.entries.items() if e.get('file')), key=self._eviction_key):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, entry['file']))
+            except OSError:
+                pass
+            total -= entry['size']
+            entry['file'] = None
+            entry['size'] = 0
+
+    def _prune_counters(self):
+        # I contatori delle tracce mai salvate non devono crescere all'infinito
+        if len(self.entries) <= AUDIO_CACHE_MAX_COUNTERS:
+            return
+        uncached = sorted(((k, e) for k, e in self.entries.items() if not e.get('file')), key=self._eviction_key)
+        for video_id, _ in uncached[:len(self.entries) - AUDIO_CACHE_MAX_COUNTERS]:
+            del self.entries[video_id]
 
-    for entry in info.get('entries', []):
-        title = entry.get('title', 'Sconosciuto')
-        video_id = entry.get('id')
-        if not video_id:
+audio_cache = None  # creata in main(): il processo launcher non deve toccare la cartella
+
+# --- YouTube API search ---
+SEARCH_RESULTS = 5
+
+# --- Catalogo locale delle tracce ---
+CATALOG_ENABLED = os.getenv("CATALOG", "1") == "1"
+CATALOG_DB = os.getenv("CATALOG_DB", STATE_DB)
+CATALOG_FLUSH_INTERVAL = 5.0
+CATALOG_MIN_RESULTS = 3  # sotto questa soglia si chiede anche a YouTube
+CATALOG_CANDIDATES = 50  # risultati FTS da riordinare per popolarità
+
+def fts_query(query):
+    """Ogni parola diventa un prefisso FTS5: "never gon" -> "never"* "gon"*"""
+    words = normalize_query(query).split()
+    return " ".join('"' + w.replace('"', '""') + '"*' for w in words)
+
+class TrackCatalog:
+    """Catalogo SQLite (FTS5) di tutte le tracce accodate, per cercare senza yt-dlp.
+
+    Le scritture sono differite e a blocchi; le letture usano connessioni proprie (WAL),
+    quindi non aspettano le scritture.
+    """
+    def __init__(self, path=CATALOG_DB):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="catalog")
+        self.local = threading.local()
+        self.pending = {}   # video_id -> riga da inserire/aggiornare
+        self.plays = {}     # video_id -> ascolti da aggiungere
+        self.task = None
+        self.ready = False
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS tracks (
+                    video_id TEXT PRIMARY KEY, title TEXT, channel TEXT, duration REAL,
+                    thumbnail TEXT, url TEXT, plays INTEGER DEFAULT 0, queued INTEGER DEFAULT 0, last_seen REAL);
+                CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+                    title, channel, content='tracks', tokenize='unicode61 remove_diacritics 2', prefix='2 3');
+                CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+                    INSERT INTO tracks_fts(rowid, title, channel) VALUES (new.rowid, new.title, new.channel);
+                END;
+                CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE OF title, channel ON tracks BEGIN
+                    INSERT INTO tracks_fts(tracks_fts, rowid, title, channel) VALUES ('delete', old.rowid, old.title, old.channel);
+                    INSERT INTO tracks_fts(rowid, title, channel) VALUES (new.rowid, new.title, new.channel);
+                END;
+            """)
+        return conn
+
+    def record(self, entry):
+        """Segna una voce accodata (dict flat di yt-dlp)"""
+        url = entry.get('webpage_url') or entry.get('url')
+        title = entry.get('title')
+        if not url or not title:
+            return
+        video_id = video_id_from_url(url)
+        row = self.pending.get(video_id)
+        queued = row[7] + 1 if row else 1
+        self.pending[video_id] = (video_id, title, entry.get('channel') or entry.get('uploader'),
+                                  entry.get('duration'), entry_thumbnail(entry), url, 0, queued, time.time())
+        self._start()
+
+    def record_play(self, url):
+        video_id = video_id_from_url(url)
+        self.plays[video_id] = self.plays.get(video_id, 0) + 1
+        self._start()
+
+    def _start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(CATALOG_FLUSH_INTERVAL)
+        await self.flush()
+
+    async def flush(self):
+        rows, self.pending = list(self.pending.values()), {}
+        plays, self.plays = list(self.plays.items()), {}
+        if rows or plays:
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.executor, self._write, rows, plays)
+            except Exception as e:
+                print(f"[Catalog] Errore salvando il catalogo: {e}")
+
+    def _write(self, rows, plays):
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(video_id) DO UPDATE SET "
+                "title = excluded.title, channel = COALESCE(excluded.channel, channel), "
+                "duration = COALESCE(excluded.duration, duration), thumbnail = COALESCE(excluded.thumbnail, thumbnail), "
+                "queued = queued + excluded.queued, last_seen = excluded.last_seen", rows)
+            conn.executemany("UPDATE tracks SET plays = plays + ? WHERE video_id = ?", [(n, v) for v, n in plays])
+
+    def _search(self, match, limit):
+        rows = self._conn().execute(
+            "SELECT t.video_id, t.title, t.channel, t.duration, t.thumbnail, t.url, t.plays, bm25(tracks_fts) "
+            "FROM tracks_fts JOIN tracks t ON t.rowid = tracks_fts.rowid "
+            "WHERE tracks_fts MATCH ? ORDER BY bm25(tracks_fts) LIMIT ?", (match, CATALOG_CANDIDATES)).fetchall()
+        # bm25 è negativo (più basso = più pertinente): si somma la popolarità
+        rows.sort(key=lambda r: r[7] - 2 * math.log1p(r[6]))
+        return [
+            {'id': r[0], 'title': r[1], 'channel': r[2], 'duration': r[3], 'thumbnail': r[4], 'webpage_url': r[5]}
+            for r in rows[:limit]
+        ]
+
+    async def search(self, query, limit=SEARCH_RESULTS):
+        """Voci flat dal catalogo, ordinate per pertinenza e popolarità"""
+        match = fts_query(query)
+        if not match:
+            return []
+        try:
+            with metrics.timer('catalog_search'):
+                return await asyncio.get_running_loop().run_in_executor(self.executor, self._search, match, limit)
+        except sqlite3.Error as e:
+            print(f"[Catalog] Errore nella ricerca: {e}")
+            return []
+
+catalog = TrackCatalog() if CATALOG_ENABLED else None
+
+
+async def search_youtube_entries(query: str, guild_id=None, limit=SEARCH_RESULTS, bulk=False):
+    """Risultati flat della ricerca (id, titolo, durata, miniature) senza risolvere gli stream.
+
+    Prima il catalogo locale; YouTube solo se lì non ci sono abbastanza risultati.
+    """
+    # Anche per limit=1 servono CATALOG_MIN_RESULTS candidati: un solo match di prefisso non basta
+    local = await catalog.search(query, max(limit, CATALOG_MIN_RESULTS)) if catalog else []
+    if len(local) >= CATALOG_MIN_RESULTS:
+        metrics.inc('musicnow_search_total', source='catalog')
+        return local[:limit]
+    metrics.inc('musicnow_search_total', source='youtube')
+    remote = await search_youtube_remote(query, guild_id, limit, bulk)
+    # Qui YouTube ha la precedenza: i pochi match locali completano solo la lista
+    seen = {e['id'] for e in remote}
+    return (remote + [e for e in local if e['id'] not in seen])[:limit]
+
+async def search_youtube_remote(query, guild_id=None, limit=SEARCH_RESULTS, bulk=False):
+    with metrics.timer('search'):
+        if bulk:
+            info = await resolver.extract_bulk(f"ytsearch{limit}:{query}")
+        else:
+            info = await resolver.extract(f"ytsearch{limit}:{query}", profile='search', guild_id=guild_id)
+    entries = []
+    for entry in (info or {}).get('entries') or []:
+        if not entry or not entry.get('id'):
             continue
-        display_title = title if len(title) <= 100 else title[:97] + "..."
-        results.append(app_commands.Choice(
-            name=display_title,
-            value=f"https://www.youtube.com/watch?v={video_id}"
-        ))
+        entry.setdefault('webpage_url', f"https://www.youtube.com/watch?v={entry['id']}")
+        entries.append(entry)
+    return entries
+
+async def search_youtube_yt_dlp(query: str, guild_id=None):
+    """Cerca su YouTube senza API key usando yt-dlp e ritorna Choice già pronti"""
+    results = []
+
+    for entry in await search_youtube_entries(query, guild_id):
+        results.append(entry_choice(entry))
 
     return results
 
-autocomplete_cache = {}  # semplice cache 10 sec
+def entry_choice(entry):
+    title = entry.get('title') or 'Sconosciuto'
+    display_title = title if len(title) <= 100 else title[:97] + "..."
+    return app_commands.Choice(name=display_title, value=entry['webpage_url'])
+
+# --- Autocomplete ---
+AUTOCOMPLETE_TTL = 120          # risultati considerati freschi
+AUTOCOMPLETE_STALE_TTL = 1800   # oltre il TTL si servono ancora, rinnovandoli in background
+AUTOCOMPLETE_CACHE_SIZE = 1000
+AUTOCOMPLETE_DEBOUNCE = 0.35
+AUTOCOMPLETE_MAX_SEARCHES = int(os.getenv("AUTOCOMPLETE_MAX_SEARCHES", "3"))
+AUTOCOMPLETE_TIMEOUT = 2.5
+AUTOCOMPLETE_SWR = True
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+def choice_matches(choice, query):
+    """True se tutte le parole della query compaiono nel titolo (l'ultima anche solo come prefisso)"""
+    words = query.split()
+    title_words = choice.name.lower().split()
+    if not all(w in choice.name.lower() for w in words[:-1]):
+        return False
+    return any(t.startswith(words[-1]) for t in title_words)
+
+class AutocompleteEngine:
+    """Cache con TTL/LRU e riuso per prefisso, debounce per utente e tetto alle ricerche concorrenti"""
+    def __init__(self):
+        self.cache = OrderedDict()  # query normalizzata -> (timestamp, choices)
+        self.searches = None
+        self.pending = {}           # user_id -> task di ricerca in corso
+        self.refreshing = {}        # query -> task di rinnovo in background
+
+    def _store(self, query, choices):
+        self.cache[query] = (time.monotonic(), choices)
+        self.cache.move_to_end(query)
+        while len(self.cache) > AUTOCOMPLETE_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def _lookup(self, query):
+        """Ritorna (choices, stato) con stato "fresh", "stale" o "prefix"; (None, None) se non c'è nulla"""
+        now = time.monotonic()
+        entry = self.cache.get(query)
+        if entry and now - entry[0] < AUTOCOMPLETE_STALE_TTL:
+            self.cache.move_to_end(query)
+            return entry[1], 'fresh' if now - entry[0] < AUTOCOMPLETE_TTL else 'stale'
+        # Riuso per prefisso: "never gon" <-> "never gonna"
+        for key, (stamp, choices) in reversed(self.cache.items()):
+            if now - stamp >= AUTOCOMPLETE_STALE_TTL:
+                continue
+            if key.startswith(query) or query.startswith(key):
+                matching = [c for c in choices if choice_matches(c, query)]
+                if matching:
+                    return matching, 'prefix'
+        return None, None
+
+    async def _search(self, query, guild_id, delay=0):
+        if delay:
+            await asyncio.sleep(delay)
+        if self.searches is None:
+            self.searches = asyncio.Semaphore(AUTOCOMPLETE_MAX_SEARCHES)
+        async with self.searches:
+            choices = await search_youtube_yt_dlp(query, guild_id)
+        self._store(query, choices)
+        return choices
+
+    def _revalidate(self, query, guild_id):
+        if query in self.refreshing:
+            return
+        task = asyncio.create_task(self._search(query, guild_id))
+        self.refreshing[query] = task
+        task.add_done_callback(lambda t: (self.refreshing.pop(query, None), t.cancelled() or t.exception()))
+
+    def _debounced(self, user_id, query, guild_id):
+        """Ricerca dopo il debounce; ogni nuovo tasto annulla quella precedente dello stesso utente"""
+        previous = self.pending.pop(user_id, None)
+        if previous and not previous.done():
+            previous.cancel()
+        task = asyncio.create_task(self._search(query, guild_id, AUTOCOMPLETE_DEBOUNCE))
+        self.pending[user_id] = task
+        task.add_done_callback(lambda t: self._finished(user_id, t))
+        return task
+
+    def _finished(self, user_id, task):
+        if self.pending.get(user_id) is task:
+            del self.pending[user_id]
+        if not task.cancelled():
+            task.exception()
+
+    async def complete(self, user_id, guild_id, query):
+        query = normalize_query(query)
+        if not query:
+            return []
+        # Il catalogo locale risponde in pochi ms: se basta, niente debounce né yt-dlp
+        local = await catalog.search(query) if catalog else []
+        if len(local) >= CATALOG_MIN_RESULTS:
+            return [entry_choice(e) for e in local]
+        choices, state = self._lookup(query)
+        if state == 'fresh':
+            return choices
+        if state == 'stale':
+            # Solo la chiave esatta scaduta si rinnova subito (stale-while-revalidate)
+            if AUTOCOMPLETE_SWR:
+                self._revalidate(query, guild_id)
+            return choices
+        task = self._debounced(user_id, query, guild_id)
+        if state == 'prefix':
+            # Risposta immediata dal prefisso; la query vera passa dal debounce e riempie la cache
+            return choices
+        try:
+            # shield: se scade il timeout la ricerca continua e riempie la cache per il prossimo tasto
+            return await asyncio.wait_for(asyncio.shield(task), timeout=AUTOCOMPLETE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return []
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return []
+            raise
+
+autocomplete_engine = AutocompleteEngine()
 
 async def ytsearch_autocomplete(interaction: Interaction, current: str):
-    query = current.strip()
-    if not query:
-        return []
-
     try:
-        # Ottieni direttamente una lista di Choice
-        results = await asyncio.wait_for(search_youtube_yt_dlp(query), timeout=2.5)
-        return results
-    except asyncio.TimeoutError:
-        return []
+        return await autocomplete_engine.complete(interaction.user.id, interaction.guild_id, current)
     except Exception as e:
         print(f"Errore autocomplete yt-dlp: {e}")
         return []
 
+# --- Pagine della coda ---
+QUEUE_PAGE_SIZE = 25  # limite di opzioni di un Select di Discord
+
+def queue_page_count(queue):
+    return max(1, -(-len(queue) // QUEUE_PAGE_SIZE))
+
+def queue_page(guild_data, page):
+    """Righe (posizione, titolo, id) di una sola pagina, in cache finché la coda non cambia"""
+    queue = guild_data['queue']
+    cache = guild_data['queue_pages']
+    if cache.get('version') != queue.version:
+        cache.clear()
+        cache['version'] = queue.version
+    rows = cache.get(page)
+    if rows is None:
+        start = page * QUEUE_PAGE_SIZE
+        rows = cache[page] = [
+            (start + i + 1, t.title, t.id)
+            for i, t in enumerate(queue.slice(start, start + QUEUE_PAGE_SIZE))
+        ]
+    return rows
+
+def add_queue_page_items(view, page):
+    """Aggiunge a `view` il Select della pagina corrente e, se servono, i bottoni di navigazione"""
+    if not view.guild_data['queue']:
+        return
+    pages = queue_page_count(view.guild_data['queue'])
+    view.add_item(QueueSelectStandalone(view, page))
+    if pages > 1:
+        view.add_item(QueuePageButton(view, page, -1, pages))
+        view.add_item(QueuePageButton(view, page, 1, pages))
+
 # --- PlayerView ---
 class PlayerView(discord.ui.View):
     def __init__(self, guild_id):
@@ -119,18 +1528,28 @@ class PlayerView(discord.ui.View):
         self.add_item(NextButton(guild_id))
 
         # Aggiungi select solo se coda non vuota
-        if self.guild_data['queue']:
-            self.add_item(QueueSelectStandalone(self))
+        add_queue_page_items(self, self.page)
+
+    @property
+    def page(self):
+        # La pagina vive nello stato della guild: la View viene ricreata a ogni render
+        page = min(self.guild_data['queue_page'], queue_page_count(self.guild_data['queue']) - 1)
+        self.guild_data['queue_page'] = page
+        return page
 
     async def refresh_queue(self):
         """Aggiorna o crea il Select della coda dinamicamente"""
-        # Rimuovi vecchio Select
-        for item in self.children:
-            if isinstance(item, QueueSelectStandalone):
+        # Rimuovi vecchio Select e bottoni pagina
+        for item in list(self.children):
+            if isinstance(item, (QueueSelectStandalone, QueuePageButton)):
                 self.remove_item(item)
         # Aggiungi nuovo Select solo se coda non vuota
-        if self.guild_data['queue']:
-            self.add_item(QueueSelectStandalone(self))
+        add_queue_page_items(self, self.page)
+
+    async def show_page(self, interaction, page):
+        self.guild_data['queue_page'] = page
+        await self.refresh_queue()
+        await interaction.response.edit_message(view=self)
 
 # --- Bottoni principali ---
 class PlayResumeButton(discord.ui.Button):
@@ -143,8 +1562,19 @@ class PlayResumeButton(discord.ui.Button):
         vc = interaction.guild.voice_client
         if vc and vc.is_paused():
             vc.resume()
-            guild_data['paused'] = False
+            set_paused(self.guild_id, False)
             await interaction.response.send_message("▶️ Ripresa riproduzione.", ephemeral=True)
+        elif guild_data['resume_at'] is not None:
+            # Traccia interrotta da una disconnessione voice: si rientra e si riparte dalla posizione salvata
+            voice = interaction.user.voice
+            channel = voice.channel if voice and voice.channel else None
+            if (not vc or not vc.is_connected()) and channel is None:
+                return await interaction.response.send_message("❌ Devi essere in un canale vocale!", ephemeral=True)
+            await interaction.response.send_message("▶️ Ripresa dal punto di interruzione.", ephemeral=True)
+            if not vc or not vc.is_connected():
+                vc = await ensure_vc_connected(interaction.guild, channel)
+            if vc:
+                await play_next(interaction.guild, vc)
         else:
             await interaction.response.send_message("⚠️ Nulla da riprodurre.", ephemeral=True)
 
@@ -154,11 +1584,10 @@ class PauseButton(discord.ui.Button):
         self.guild_id = guild_id
 
     async def callback(self, interaction: discord.Interaction):
-        guild_data = get_guild_data(self.guild_id)
         vc = interaction.guild.voice_client
         if vc and vc.is_playing():
             vc.pause()
-            guild_data['paused'] = True
+            set_paused(self.guild_id, True)
             await interaction.response.send_message("⏸️ Musica messa in pausa.", ephemeral=True)
         else:
             await interaction.response.send_message("❌ Nessuna musica in riproduzione.", ephemeral=True)
@@ -172,10 +1601,9 @@ class StopButton(discord.ui.Button):
         guild_data = get_guild_data(self.guild_id)
         guild_data['queue'].clear()
         guild_data['current_track'] = None
-        guild_data['paused'] = False
-        vc = interaction.guild.voice_client
-        if vc and (vc.is_playing() or vc.is_paused()):
-            vc.stop()
+        set_paused(self.guild_id, False)
+        # Il player annulla anche un avvio in corso e programma l'uscita dal canale
+        get_player(interaction.guild).stop()
 
         # Cancella il messaggio del player
         if guild_data['player_message']:
@@ -193,29 +1621,42 @@ class NextButton(discord.ui.Button):
         self.guild_id = guild_id
 
     async def callback(self, interaction: discord.Interaction):
-        vc = interaction.guild.voice_client
-        if vc and (vc.is_playing() or vc.is_paused()):
-            vc.stop()
+        get_player(interaction.guild).skip()
         await interaction.response.send_message("⏭ Passata alla traccia successiva.", ephemeral=True)
 
 # --- Select per eliminare tracce ---
 class QueueSelectStandalone(discord.ui.Select):
-    def __init__(self, parent):
-        self.parent = parent
+    def __init__(self, parent, page=0):
+        # `parent` è già una property di discord.ui.Item (la View che lo contiene)
+        self.owner = parent
         options = [
-            discord.SelectOption(label=f"{i+1}. {t['title'][:90]}", value=str(i))
-            for i, t in enumerate(parent.guild_data['queue'])
+            discord.SelectOption(label=f"{pos}. {title[:90]}", value=str(track_id))
+            for pos, title, track_id in queue_page(parent.guild_data, page)
         ]
-        super().__init__(placeholder="Seleziona traccia da eliminare", options=options, min_values=1, max_values=1)
+        super().__init__(placeholder="Seleziona traccia da eliminare", options=options, min_values=1, max_values=1, row=1)
 
     async def callback(self, interaction: discord.Interaction):
-        idx = int(self.values[0])
-        removed = self.parent.guild_data['queue'].pop(idx)
-        await interaction.response.send_message(f"❌ Rimosso dalla coda: **{removed['title']}**", ephemeral=True)
+        removed = self.owner.guild_data['queue'].remove(int(self.values[0]))
+        if removed is None:
+            return await interaction.response.send_message("⚠️ Traccia già rimossa dalla coda.", ephemeral=True)
+        await interaction.response.send_message(f"❌ Rimosso dalla coda: **{removed.title}**", ephemeral=True)
         # Aggiorna Select nella view
-        await self.parent.refresh_queue()
+        await self.owner.refresh_queue()
         await update_player_message(interaction.guild)
 
+class QueuePageButton(discord.ui.Button):
+    def __init__(self, parent, page, delta, pages):
+        label = "◀️" if delta < 0 else "▶️"
+        if delta > 0:
+            label = f"{page + 1}/{pages} {label}"
+        disabled = not 0 <= page + delta < pages
+        super().__init__(label=label, style=discord.ButtonStyle.secondary, disabled=disabled, row=2)
+        self.owner = parent
+        self.target = page + delta
+
+    async def callback(self, interaction: discord.Interaction):
+        await self.owner.show_page(interaction, self.target)
+
 class MusicButtons(discord.ui.Button):
   def __init__(self, guild_id):
       super().__init__(style=discord.ButtonStyle.green, label="▶️ Play/Resume")
@@ -223,18 +1664,18 @@ class MusicButtons(discord.ui.Button):
 
   async def callback(self, interaction: discord.Interaction):
       vc = interaction.guild.voice_client
-      guild_data = get_guild_data(self.guild_id)
       if vc and vc.is_paused():
           vc.resume()
-          guild_data['paused'] = False
+          set_paused(self.guild_id, False)
           await interaction.response.send_message("▶️ Ripresa riproduzione.", ephemeral=True)
       else:
           await interaction.response.send_message("⚠️ Nulla da riprodurre.", ephemeral=True)
 
   async def callback(self, interaction: discord.Interaction):
-      idx = int(self.values[0])
-      removed = self.parent.guild_data['queue'].pop(idx)
-      await interaction.response.send_message(f"❌ Rimosso dalla coda: **{removed['title']}**", ephemeral=True)
+      removed = self.parent.guild_data['queue'].remove(int(self.values[0]))
+      if removed is None:
+          return await interaction.response.send_message("⚠️ Traccia già rimossa dalla coda.", ephemeral=True)
+      await interaction.response.send_message(f"❌ Rimosso dalla coda: **{removed.title}**", ephemeral=True)
       # aggiorna la view
       await update_player_message(interaction.guild)
 
@@ -261,7 +1702,7 @@ class MusicView(discord.ui.View):
         vc = interaction.guild.voice_client
         if vc and vc.is_paused():
             vc.resume()
-            guild_data['paused'] = False
+            set_paused(self.guild_id, False)
             await interaction.response.send_message("▶️ Ripresa riproduzione.", ephemeral=True)
         elif vc and not vc.is_playing():
             if guild_data['queue']:
@@ -274,11 +1715,10 @@ class MusicView(discord.ui.View):
 
     @discord.ui.button(label="⏸ Pause", style=discord.ButtonStyle.secondary)
     async def pause(self, button: discord.ui.Button, interaction: discord.Interaction):
-        guild_data = get_guild_data(self.guild_id)
         vc = interaction.guild.voice_client
         if vc and vc.is_playing():
             vc.pause()
-            guild_data['paused'] = True
+            set_paused(self.guild_id, True)
             await interaction.response.send_message("⏸️ Musica messa in pausa.", ephemeral=True)
         else:
             await interaction.response.send_message("❌ Nessuna musica in riproduzione.", ephemeral=True)
@@ -288,17 +1728,14 @@ class MusicView(discord.ui.View):
         guild_data = get_guild_data(self.guild_id)
         guild_data['queue'].clear()
         guild_data['current_track'] = None
-        guild_data['paused'] = False
-        vc = interaction.guild.voice_client
-        if vc and (vc.is_playing() or vc.is_paused()):
-            vc.stop()
+        set_paused(self.guild_id, False)
+        # Il player annulla anche un avvio in corso e programma l'uscita dal canale
+        get_player(interaction.guild).stop()
         await interaction.response.send_message("⏹️ Riproduzione fermata e coda svuotata.", ephemeral=True)
 
     @discord.ui.button(label="⏭ Next", style=discord.ButtonStyle.primary)
     async def next(self, button: discord.ui.Button, interaction: discord.Interaction):
-        vc = interaction.guild.voice_client
-        if vc and (vc.is_playing() or vc.is_paused()):
-            vc.stop()
+        get_player(interaction.guild).skip()
         await interaction.response.send_message("⏭ Passata alla traccia successiva.", ephemeral=True)
 
 # --- View separata per la coda interattiva ---
@@ -309,39 +1746,164 @@ class QueueView(discord.ui.View):
         self.guild_data = get_guild_data(ctx.guild.id)
         self.queue = self.guild_data['queue']
         self.message = None
+        self.signature = None
+        self.page = 0
         self.refresh_menu()
         active_queue_views[ctx.guild.id] = self
 
     def refresh_menu(self):
         self.clear_items()
-        if self.queue:
-            self.add_item(QueueSelect(self))
+        self.page = min(self.page, queue_page_count(self.queue) - 1)
+        add_queue_page_items(self, self.page)
+
+    async def refresh_queue(self):
+        self.refresh_menu()
+
+    def build_embed(self):
+        rows = queue_page(self.guild_data, self.page)
+        description = "\n".join(f"{pos}. {title}" for pos, title, _ in rows) or "La coda è vuota."
+        embed = discord.Embed(title="📜 Coda aggiornata", description=description, color=discord.Color.blurple())
+        embed.set_footer(text=f"Pagina {self.page + 1}/{queue_page_count(self.queue)} · {len(self.queue)} tracce")
+        return embed
+
+    async def show_page(self, interaction, page):
+        self.page = page
+        self.refresh_menu()
+        embed = self.build_embed()
+        await interaction.response.edit_message(embed=embed, view=self)
+        self.signature = render_signature(embed, self)
 
     async def update_embed(self):
         if self.message:
-            description = "\n".join(f"{i+1}. {t['title']}" for i, t in enumerate(self.queue)) or "La coda è vuota."
-            embed = discord.Embed(title="📜 Coda aggiornata", description=description, color=discord.Color.blurple())
-            await self.message.edit(embed=embed, view=self)
+            self.refresh_menu()
+            embed = self.build_embed()
+            signature = render_signature(embed, self)
+            if signature == self.signature:
+                return
+            await edit_limiter.acquire(self.message.channel.id)
+            with metrics.timer('message_edit'):
+                await self.message.edit(embed=embed, view=self)
+            self.signature = signature
 
     async def on_timeout(self):
-        if self.ctx.guild.id in active_queue_views:
+        if active_queue_views.get(self.ctx.guild.id) is self:
             del active_queue_views[self.ctx.guild.id]
         if self.message:
             await self.message.edit(view=None)
 
     async def callback(self, interaction: discord.Interaction):
-        idx = int(self.values[0])
-        if 0 <= idx < len(self.parent.queue):
-            removed = self.parent.queue.pop(idx)
-            await interaction.response.send_message(f"❌ Rimosso dalla coda: **{removed['title']}**", ephemeral=True)
+        removed = self.parent.queue.remove(int(self.values[0]))
+        if removed is not None:
+            await interaction.response.send_message(f"❌ Rimosso dalla coda: **{removed.title}**", ephemeral=True)
             # disabilita il menu dopo la selezione
             for item in self.parent.children:
                 item.disabled = True
             await self.parent.update_embed()
 
 
+# --- Render coalescente dei messaggi ---
+RENDER_INTERVAL = float(os.getenv("RENDER_INTERVAL", "3"))
+# Limiti REST di Discord: ~50 richieste/s globali, 5 modifiche ogni 5 s per canale
+GLOBAL_EDIT_RATE = (45, 1.0)
+CHANNEL_EDIT_RATE = (5, 5.0)
+
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """Consuma un token; ritorna quanti secondi bisogna aspettare prima di usarlo"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class EditRateLimiter:
+    """Distribuisce le modifiche dei messaggi entro i bucket di Discord, prima di prendere 429"""
+    def __init__(self):
+        self.global_bucket = TokenBucket(*GLOBAL_EDIT_RATE)
+        self.channels = {}
+
+    async def acquire(self, channel_id):
+        bucket = self.channels.get(channel_id)
+        if bucket is None:
+            bucket = self.channels[channel_id] = TokenBucket(*CHANNEL_EDIT_RATE)
+        wait = max(bucket.delay(), self.global_bucket.delay())
+        if wait:
+            await asyncio.sleep(wait)
+        # I bucket pieni non servono più: evita che il dict cresca all'infinito
+        if len(self.channels) > 1000:
+            now = time.monotonic()
+            for key in [k for k, b in self.channels.items() if now - b.updated > CHANNEL_EDIT_RATE[1]]:
+                del self.channels[key]
+
+edit_limiter = EditRateLimiter()
+
+class RenderScheduler:
+    """Accorpa le notifiche "stato cambiato" in al massimo un render per intervallo e per chiave"""
+    def __init__(self, interval=RENDER_INTERVAL):
+        self.interval = interval
+        self.targets = {}   # chiave -> (funzione di render, argomento più recente)
+        self.dirty = set()
+        self.tasks = {}
+        self.last = {}
+
+    def mark_dirty(self, key, render, target):
+        self.targets[key] = (render, target)
+        task = self.tasks.get(key)
+        if task and not task.done():
+            self.dirty.add(key)
+            return
+        self.tasks[key] = asyncio.create_task(self._run(key))
+
+    async def _run(self, key):
+        try:
+            while True:
+                wait = self.last.get(key, 0) + self.interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self.dirty.discard(key)
+                self.last[key] = time.monotonic()
+                render, target = self.targets[key]
+                try:
+                    await render(target)
+                except Exception as e:
+                    print(f"[Music] Errore aggiornando il messaggio {key}: {e}")
+                if key not in self.dirty:
+                    break
+        finally:
+            del self.tasks[key]
+            del self.targets[key]
+            # L'ultimo render serve solo finché potrebbe ancora limitare il prossimo
+            asyncio.get_running_loop().call_later(self.interval, self._forget, key)
+
+    def _forget(self, key):
+        if key not in self.tasks and time.monotonic() - self.last.get(key, 0) >= self.interval:
+            self.last.pop(key, None)
+
+render_scheduler = RenderScheduler()
+
+def render_signature(embed, view):
+    """Firma del contenuto renderizzato, per saltare le modifiche che non cambiano nulla"""
+    items = tuple(
+        (type(item).__name__, getattr(item, 'label', None), getattr(item, 'disabled', False),
+         tuple(o.label for o in getattr(item, 'options', ())))
+        for item in view.children
+    ) if view else ()
+    return (repr(embed.to_dict()), items)
+
 # --- Funzioni principali ---
 async def update_player_message(guild):
+    """Segnala che il player è cambiato: il render vero avviene al massimo una volta per intervallo"""
+    state_store.mark_dirty(guild.id)
+    render_scheduler.mark_dirty(('player', guild.id), render_player_message, guild)
+    await refresh_queue_embed(guild.id)
+
+async def render_player_message(guild):
     guild_data = get_guild_data(guild.id)
     current = guild_data['current_track']
     if not current:
@@ -349,96 +1911,663 @@ async def update_player_message(guild):
 
     embed = discord.Embed(
         title="🎶 In riproduzione",
-        description=current['title'],
+        description=current.title,
         color=0x1DB954
     )
-    if current.get('thumbnail'):
-        embed.set_thumbnail(url=current['thumbnail'])
+    if current.thumbnail:
+        embed.set_thumbnail(url=current.thumbnail)
 
     # Ricrea sempre la View con la coda aggiornata
     view = PlayerView(guild.id)
     await view.refresh_queue()
 
+    signature = render_signature(embed, view)
+    if guild_data['player_message'] and guild_data.get('player_signature') == signature:
+        return
+
     if guild_data['player_message']:
         try:
-            await guild_data['player_message'].edit(embed=embed, view=view)
+            await edit_limiter.acquire(guild_data['player_message'].channel.id)
+            with metrics.timer('message_edit'):
+                await guild_data['player_message'].edit(embed=embed, view=view)
+            guild_data['player_signature'] = signature
+            set_player_view(guild_data, view)
         except:
             guild_data['player_message'] = None
+            set_player_view(guild_data, None)
     else:
         channel = next(
             (ch for ch in guild.text_channels if ch.permissions_for(guild.me).send_messages),
             None
         )
         if channel:
-            msg = await channel.send(embed=embed, view=view)
+            await edit_limiter.acquire(channel.id)
+            with metrics.timer('message_send'):
+                msg = await channel.send(embed=embed, view=view)
             guild_data['player_message'] = msg
+            guild_data['player_signature'] = signature
+            set_player_view(guild_data, view)
+
+def set_player_view(guild_data, view):
+    """La View del player ha timeout=None: quella sostituita va fermata o discord.py la tiene per sempre"""
+    previous = guild_data['player_view']
+    if previous is not None and previous is not view:
+        previous.stop()
+    guild_data['player_view'] = view
 
 async def ensure_vc_connected(guild, voice_channel):
     try:
         vc = guild.voice_client
-        if not vc or not vc.is_connected():
-            vc = await voice_channel.connect()
-        elif vc.channel != voice_channel:
-            await vc.move_to(voice_channel)
+        with metrics.timer('voice_connect'):
+            if not vc or not vc.is_connected():
+                vc = await voice_channel.connect()
+            elif vc.channel != voice_channel:
+                await vc.move_to(voice_channel)
         return vc
     except Exception as e:
+        metrics.inc('musicnow_voice_connect_errors_total')
         print(f"[Music] Errore connessione voice: {e}")
         return None
 
-async def play_next(guild, vc=None, seek_time=0):
-    guild_data = get_guild_data(guild.id)
-    queue = guild_data['queue']
+STREAM_BEFORE_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+
+def make_audio_source(source, acodec=None, seek_time=0, local=False):
+    """Crea la sorgente FFmpeg senza ffprobe: il codec lo sappiamo già da yt-dlp (o dalla cache).
+
+    Se l'audio è già Opus lo si rimuxa in Ogg con copy, altrimenti si codifica in Opus.
+    """
+    before_opts = [] if local else [STREAM_BEFORE_OPTIONS]
+    if seek_time > 0:
+        before_opts.append(f"-ss {seek_time}")
+    codec = 'copy' if acodec == 'opus' else None
+    return discord.FFmpegOpusAudio(source, codec=codec, before_options=" ".join(before_opts) or None, options='-vn')
+
+# --- Player per guild (macchina a stati) ---
+IDLE, RESOLVING, PLAYING, PAUSED, DRAINING = "idle", "resolving", "playing", "paused", "draining"
+IDLE_DISCONNECT_AFTER = 60
+TRACK_MAX_ATTEMPTS = 3       # tentativi per traccia se l'errore può essere temporaneo
+TRACK_RETRY_BACKOFF = 2.0    # secondi, raddoppiano a ogni tentativo
+DEAD_TRACK_BACKOFF_MAX = 5.0 # pausa massima tra tracce morte consecutive
+RESUME_MAX_ATTEMPTS = 3      # riprese automatiche per traccia dopo uno stream interrotto
+RESUME_MIN_REMAINING = 5.0   # se mancano meno secondi di così la traccia si considera finita
+VOICE_RECONNECT_WAIT = 15.0
+
+class TimerWheel:
+    """Un solo task per tutti i timer (es. disconnessione per inattività), a granularità di secondi"""
+    def __init__(self, resolution=1.0):
+        self.resolution = resolution
+        self.slots = {}   # tick -> {chiave: callback}
+        self.keys = {}    # chiave -> tick
+        self.task = None
+
+    def schedule(self, key, delay, callback):
+        self.cancel(key)
+        tick = int((time.monotonic() + delay) / self.resolution) + 1
+        self.slots.setdefault(tick, {})[key] = callback
+        self.keys[key] = tick
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def cancel(self, key):
+        tick = self.keys.pop(key, None)
+        if tick is not None:
+            slot = self.slots[tick]
+            del slot[key]
+            if not slot:
+                del self.slots[tick]
+
+    async def _run(self):
+        while self.slots:
+            await asyncio.sleep(self.resolution)
+            now = int(time.monotonic() / self.resolution)
+            for tick in [t for t in self.slots if t <= now]:
+                for key, callback in self.slots.pop(tick).items():
+                    del self.keys[key]
+                    try:
+                        result = callback()
+                        if asyncio.iscoroutine(result):
+                            asyncio.create_task(result)
+                    except Exception as e:
+                        print(f"[Music] Errore nel timer {key}: {e}")
+
+idle_timers = TimerWheel()
+
+class TrackUnavailable(Exception):
+    """La traccia non è riproducibile (privata, rimossa, bloccata): inutile riprovare"""
+
+class GuildPlayer:
+    """Unico proprietario della riproduzione di una guild.
+
+    Tutti gli avvii passano dalla coda di eventi del player e vengono gestiti uno alla volta,
+    quindi due bottoni premuti insieme non possono far partire due tracce.
+    """
+    def __init__(self, guild):
+        self.guild = guild
+        self.state = IDLE
+        self.events = asyncio.Queue()
+        self.task = None
+        self.generation = 0  # cambia a ogni avvio/stop: gli eventi vecchi vengono ignorati
+        self.skipping = None  # generazione saltata di proposito con Next
+        self.dead_tracks = 0
+        self.resumes = 0
+        self.stream_url = None  # URL letto dalla sorgente corrente, per capire quale è caduto
+
+    def post(self, event, **data):
+        """Accoda un evento; ritorna un future completato quando l'evento è stato gestito"""
+        done = asyncio.get_running_loop().create_future()
+        self.events.put_nowait((event, data, done))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return done
+
+    async def _run(self):
+        # Il task vive solo finché ci sono eventi: nessuna coroutine parcheggiata per le guild inattive
+        while not self.events.empty():
+            event, data, done = self.events.get_nowait()
+            try:
+                await self._handle(event, **data)
+            except Exception as e:
+                print(f"[Music] Errore nel player ({event}): {e}")
+            finally:
+                if not done.done():
+                    done.set_result(self.state)
+
+    async def _handle(self, event, generation=None, seek_time=0, error=None):
+        if event == 'play':
+            if self.state in (IDLE, DRAINING):
+                await self._start_next(seek_time)
+        elif event == 'track_end':
+            if generation != self.generation:
+                return  # fine di una traccia già sostituita o fermata
+            if error:
+                print(f"[Music] Errore durante la riproduzione: {error}")
+            if generation != self.skipping and await self._resume_if_cut(error):
+                return
+            await self._start_next()
+        elif event == 'seek':
+            await self._seek(seek_time)
+        elif event == 'drain':
+            await self._drain()
+
+    def stop(self):
+        """Ferma subito la traccia corrente e annulla un avvio in corso"""
+        self.generation += 1
+        vc = self.guild.voice_client
+        if vc and (vc.is_playing() or vc.is_paused()):
+            vc.stop()
+        return self.post('drain')
+
+    def skip(self):
+        """Passa alla traccia successiva (la fine voluta non viene scambiata per uno stream caduto)"""
+        self.skipping = self.generation
+        vc = self.guild.voice_client
+        if vc and (vc.is_playing() or vc.is_paused()):
+            vc.stop()
+
+    def seek(self, seconds):
+        return self.post('seek', seek_time=seconds)
+
+    def set_paused(self, paused):
+        if self.state in (PLAYING, PAUSED):
+            self.state = PAUSED if paused else PLAYING
+
+    def _after(self, generation):
+        loop = asyncio.get_running_loop()
+
+        def after_playing(err):
+            # Chiamato dal thread audio di discord.py
+            loop.call_soon_threadsafe(functools.partial(self.post, 'track_end', generation=generation, error=err))
+        return after_playing
+
+    def _next_track(self, guild_data):
+        if guild_data['loop'] and guild_data.get('current_track'):
+            return guild_data['current_track']
+        if guild_data['queue']:
+            track = guild_data['queue'].popleft()
+            guild_data['current_track'] = track
+            return track
+        return None
+
+    async def _open(self, track, seek_time, refresh=False):
+        """Prepara la sorgente audio della traccia; TrackUnavailable se non è riproducibile"""
+        video_id = video_id_from_url(track.url)
+        # Un'altra guild sta già suonando questo punto della traccia: si legge dal suo FFmpeg.
+        # Vale anche dopo uno stream caduto: la pipeline morta è finita e non viene più proposta
+        reader = self._attach(video_id, seek_time)
+        if reader:
+            return reader
+        cached_path = audio_cache.lookup(video_id) if audio_cache else None
+        if cached_path:
+            # File locale (sempre Opus): niente estrazione e niente opzioni di reconnect
+            with metrics.timer('ffmpeg_start', source='disk'):
+                source = make_audio_source(cached_path, 'opus', seek_time, local=True)
+            self.stream_url = cached_path
+            return self._share(video_id, source, seek_time, lambda pos: make_audio_source(cached_path, 'opus', pos, local=True), cached_path)
+        if refresh:
+            # L'URL precedente è scaduto o la connessione è caduta: serve uno stream nuovo
+            track_cache.invalidate(video_id, self.stream_url)
+        try:
+            info = await resolve_stream(track.url, self.guild.id)
+        except Exception as e:
+            if is_unavailable_error(e):
+                raise TrackUnavailable(track.title) from e
+            raise
+        if not info or 'url' not in info:
+            raise TrackUnavailable(track.title)
+        if track.duration is None:
+            track.duration = info.get('duration')
+        # Mentre si risolveva, un'altra guild ripartita insieme a questa può aver già aperto lo stream
+        reader = self._attach(video_id, seek_time)
+        if reader:
+            return reader
+        url2, acodec = info['url'], info.get('acodec')
+        with metrics.timer('ffmpeg_start', source='stream', codec='copy' if acodec == 'opus' else 'transcode'):
+            source = make_audio_source(url2, acodec, seek_time)
+        if audio_cache and not refresh:
+            audio_cache.record_play(video_id, url2, acodec)
+        self.stream_url = url2
+        return self._share(video_id, source, seek_time, lambda pos: make_audio_source(url2, acodec, pos), url2)
+
+    def _attach(self, video_id, seek_time):
+        if not SHARED_STREAMS_ENABLED:
+            return None
+        reader = shared_streams.attach(video_id, seek_time)
+        if reader:
+            self.stream_url = reader.pipeline.url
+        return reader
+
+    @staticmethod
+    def _share(video_id, source, seek_time, reopen, url=None):
+        if not SHARED_STREAMS_ENABLED:
+            return source
+        return shared_streams.publish(video_id, source, seek_time, reopen, url)
+
+    async def _play(self, track, seek_time=0, refresh=False):
+        """Avvia `track` da `seek_time`. False se la traccia non è riproducibile"""
+        guild = self.guild
+        guild_data = get_guild_data(guild.id)
+        idle_timers.cancel(guild.id)
+        self.state = RESOLVING
+        generation = self.generation = self.generation + 1
+        source = None
+        for attempt in range(TRACK_MAX_ATTEMPTS):
+            try:
+                source = await self._open(track, seek_time, refresh)
+                break
+            except TrackUnavailable:
+                metrics.inc('musicnow_skipped_tracks_total', reason='unavailable')
+                break
+            except Exception as e:
+                print(f"[Music] Errore preparando {track.title} (tentativo {attempt + 1}): {e}")
+                if attempt + 1 < TRACK_MAX_ATTEMPTS:
+                    await asyncio.sleep(TRACK_RETRY_BACKOFF * 2 ** attempt)
+                else:
+                    metrics.inc('musicnow_skipped_tracks_total', reason='error')
+            if generation != self.generation:
+                break
+
+        if generation != self.generation:
+            # Stop premuto mentre la traccia si preparava
+            if source:
+                source.cleanup()
+            return True
+        if source is None:
+            return False
 
-    if not vc:
         vc = guild.voice_client
-    if not vc or not vc.is_connected():
-        return
+        if not vc or not vc.is_connected():
+            # Voice caduto mentre la traccia si preparava: non va persa
+            source.cleanup()
+            self._park(track, seek_time)
+            return True
+        source = TrackedSource(source, seek_time)
+        vc.play(source, after=self._after(generation))
+        self.state = PLAYING
+        guild_data['voice_client'] = vc
+        guild_data['source'] = source
+        guild_data['elapsed'] = seek_time
+        guild_data['resume_at'] = None
+        guild_data['paused'] = False
+        state_store.mark_dirty(guild.id)
+        metrics.inc('musicnow_tracks_started_total')
+        if catalog and not refresh:
+            catalog.record_play(track.url)
+        schedule_prefetch(guild.id)
+
+        # Aggiorna messaggio player
+        await update_player_message(guild)
+        return True
+
+    async def _start_next(self, seek_time=0):
+        guild = self.guild
+        guild_data = get_guild_data(guild.id)
+        if guild_data['resume_at'] is not None:
+            # Traccia interrotta da una disconnessione: riparte da dove era arrivata
+            seek_time, guild_data['resume_at'] = guild_data['resume_at'], None
+        while True:
+            vc = guild.voice_client
+            if not vc or not vc.is_connected():
+                self.state = IDLE
+                return
+            if vc.is_playing() or vc.is_paused():
+                return
+            track = self._next_track(guild_data)
+            if track is None:
+                await self._drain()
+                return
+            self.resumes = 0
+            generation = self.generation
+            if await self._play(track, seek_time):
+                self.dead_tracks = 0
+                return
 
-    if guild_data['loop'] and guild_data.get('current_track'):
+            # Traccia morta: passa alla successiva, rallentando se ce ne sono tante di fila
+            self.dead_tracks += 1
+            if guild_data['loop']:
+                guild_data['current_track'] = None
+            seek_time = 0
+            await asyncio.sleep(min(0.1 * self.dead_tracks, DEAD_TRACK_BACKOFF_MAX))
+            if self.generation != generation + 1:
+                return  # fermato nel frattempo
+
+    async def _resume_if_cut(self, error):
+        """Se lo stream è finito prima della fine della traccia (URL scaduto, FFmpeg ha rinunciato
+        a riconnettersi, voice caduto) riprende dalla posizione raggiunta. True se ha ripreso."""
+        guild_data = get_guild_data(self.guild.id)
         track = guild_data['current_track']
-    elif queue:
-        track = queue.pop(0)
-        guild_data['current_track'] = track
-    else:
+        source = guild_data['source']
+        if track is None or source is None:
+            return False
+        position = source.position
+        cut = error is not None or (track.duration and position < track.duration - RESUME_MIN_REMAINING)
+        if not cut or self.resumes >= RESUME_MAX_ATTEMPTS:
+            return False
+        self.resumes += 1
+        metrics.inc('musicnow_stream_resumes_total')
+        print(f"[Music] Stream interrotto a {position:.0f}s di {track.title}: ripresa")
+
+        # Se è caduta la connessione voice aspetta che discord.py la ristabilisca
+        generation = self.generation
+        deadline = time.monotonic() + VOICE_RECONNECT_WAIT
+        while not (self.guild.voice_client and self.guild.voice_client.is_connected()):
+            if time.monotonic() >= deadline:
+                self._park(track, position)
+                return True
+            await asyncio.sleep(0.5)
+            if generation != self.generation:
+                return True  # Stop (o un nuovo avvio) durante l'attesa: niente ripresa
+        if generation != self.generation:
+            return True
+        return await self._play(track, position, refresh=True)
+
+    def _park(self, track, position):
+        """Nessuna connessione voice: la traccia torna in testa alla coda e riparte da `position`
+        quando il voice torna, con /play o con Play"""
+        guild_data = get_guild_data(self.guild.id)
+        guild_data['resume_at'] = position
+        guild_data['elapsed'] = position
+        guild_data['source'] = None
         guild_data['current_track'] = None
+        guild_data['queue'].insert_next(track)
+        self.state = IDLE
+        state_store.mark_dirty(self.guild.id)
+
+    async def _seek(self, seconds):
+        guild_data = get_guild_data(self.guild.id)
+        track = guild_data['current_track']
+        if track is None or self.state not in (PLAYING, PAUSED):
+            return
+        seconds = max(0, seconds)
+        if track.duration:
+            seconds = min(seconds, track.duration - 1)
+        # Nuova generazione prima dello stop: la fine della vecchia sorgente va ignorata
+        self.generation += 1
+        vc = self.guild.voice_client
+        if vc and (vc.is_playing() or vc.is_paused()):
+            vc.stop()
+        self.resumes = 0
+        await self._play(track, seconds)
+
+    async def _drain(self):
+        """Coda finita: toglie il messaggio del player e programma l'uscita dal canale"""
+        guild = self.guild
+        guild_data = get_guild_data(guild.id)
+        self.state = DRAINING
+        guild_data['current_track'] = None
+        guild_data['source'] = None
+        guild_data['resume_at'] = None
+        state_store.mark_dirty(guild.id)
         if guild_data['player_message']:
             try:
                 await guild_data['player_message'].delete()
             except:
                 pass
             guild_data['player_message'] = None
+        guild_data['player_signature'] = None
+        set_player_view(guild_data, None)
+        idle_timers.schedule(guild.id, IDLE_DISCONNECT_AFTER, self._idle_disconnect)
 
-        await asyncio.sleep(60)
-        if vc.is_connected() and not vc.is_playing():
+    async def _idle_disconnect(self):
+        vc = self.guild.voice_client
+        if self.state == DRAINING and vc and vc.is_connected() and not vc.is_playing():
             await vc.disconnect()
-        return
+        if self.state == DRAINING:
+            self.state = IDLE
 
-    try:
-        ydl_opts = {'format': 'bestaudio/best', 'quiet': True, 'ignoreerrors': True, 'geo_bypass': True}
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(track['url'], download=False)
-            if not info or 'url' not in info:
-                await play_next(guild, vc)
-                return
-            url2 = info['url']
+players = {}
 
-        before_opts = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
-        if seek_time > 0:
-            before_opts += f" -ss {seek_time}"
-        ffmpeg_opts = {'before_options': before_opts, 'options': '-vn'}
-        source = await discord.FFmpegOpusAudio.from_probe(url2, **ffmpeg_opts)
+def get_player(guild):
+    player = players.get(guild.id)
+    if player is None:
+        player = players[guild.id] = GuildPlayer(guild)
+    return player
 
-        def after_playing(err):
-            asyncio.run_coroutine_threadsafe(play_next(guild, vc), bot.loop)
+async def play_next(guild, vc=None, seek_time=0):
+    """Chiede al player della guild di avviare la prossima traccia (se non sta già suonando)"""
+    return await get_player(guild).post('play', seek_time=seek_time)
 
-        vc.play(source, after=after_playing)
+@bot.event
+async def on_voice_state_update(member, before, after):
+    """Il bot è tornato in un canale vocale: riprende la traccia interrotta dalla disconnessione"""
+    if bot.user is None or member.id != bot.user.id or after.channel is None:
+        return
+    guild = member.guild
+    guild_data = guild_states.get(guild.id)
+    if not guild_data or guild_data['resume_at'] is None:
+        return
+    # Lo stato voice arriva prima che la connessione audio sia pronta
+    deadline = time.monotonic() + VOICE_RECONNECT_WAIT
+    while not (guild.voice_client and guild.voice_client.is_connected()):
+        if time.monotonic() >= deadline:
+            return
+        await asyncio.sleep(0.5)
+    await play_next(guild, guild.voice_client)
+
+# --- Memoria delle guild ---
+GUILD_IDLE_EVICT_AFTER = float(os.getenv("GUILD_IDLE_EVICT_AFTER", "1800"))  # secondi di inattività
+GUILD_SWEEP_INTERVAL = 60.0
+GUILD_MEMORY_REPORT_INTERVAL = 300.0
+GUILD_MEMORY_BATCH = 500  # guild misurate tra una cessione del loop e l'altra
+
+def deep_size(obj, seen=None):
+    """Byte tenuti da `obj` e da ciò che contiene; gli oggetti di discord.py contano solo per sé"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif isinstance(obj, Track):
+        size += sum(deep_size(getattr(obj, name), seen) for name in Track.__slots__)
+    elif isinstance(obj, TrackQueue):
+        size += deep_size(obj.tracks, seen)
+    return size
+
+class GuildMemory:
+    """Libera lo stato delle guild inattive e tiene il conto della memoria occupata.
+
+    Una guild ferma da GUILD_IDLE_EVICT_AFTER secondi viene tolta da `guild_states`; se ha
+    ancora una coda, questa resta compressa in pochi byte e torna al prossimo get_guild_data.
+    """
+    def __init__(self, evict_after=GUILD_IDLE_EVICT_AFTER):
+        self.evict_after = evict_after
+        self.compacted = {}  # guild_id -> JSON compresso di coda e loop
+        self.report = {}
+        self.task = None
+
+    def is_compacted(self, guild_id):
+        return guild_id in self.compacted
+
+    def restore(self, guild_id, guild_data):
+        blob = self.compacted.pop(guild_id, None)
+        if blob is None:
+            return
+        saved = json.loads(zlib.decompress(blob))
+        guild_data['loop'] = saved['loop']
+        for row in saved['queue']:
+            guild_data['queue'].append(track_from_row(row))
 
-        # Aggiorna messaggio player
-        await update_player_message(guild)
+    def is_idle(self, guild_id, guild_data, now):
+        if now - guild_data['last_active'] < self.evict_after or guild_data['current_track'] is not None:
+            return False
+        vc = guild_data['voice_client']
+        if vc is not None and vc.is_connected():
+            return False
+        player = players.get(guild_id)
+        if player is not None and (player.state not in (IDLE, DRAINING) or (player.task and not player.task.done())):
+            return False
+        task = guild_data['prefetch_task']
+        return task is None or task.done()
+
+    def evict(self, guild_id):
+        guild_data = guild_states.pop(guild_id)
+        set_player_view(guild_data, None)
+        if guild_data['queue']:
+            saved = {'loop': guild_data['loop'], 'queue': [track_to_row(t) for t in guild_data['queue']]}
+            self.compacted[guild_id] = zlib.compress(json.dumps(saved).encode())
+        players.pop(guild_id, None)
+        idle_timers.cancel(guild_id)
+        view = active_queue_views.pop(guild_id, None)
+        if view is not None:
+            view.stop()
+
+    async def sweep(self):
+        now = time.monotonic()
+        idle = [g for g, d in list(guild_states.items()) if self.is_idle(g, d, now)]
+        if not idle:
+            return 0
+        # Prima si scrive lo stato: dopo l'evizione la riga in SQLite non viene più aggiornata
+        for guild_id in idle:
+            state_store.mark_dirty(guild_id)
+        await state_store.flush()
+        evicted = 0
+        now = time.monotonic()
+        for guild_id in idle:
+            guild_data = guild_states.get(guild_id)
+            if guild_data is not None and self.is_idle(guild_id, guild_data, now):
+                self.evict(guild_id)
+                evicted += 1
+        metrics.inc('musicnow_guild_evictions_total', evicted)
+        return evicted
+
+    async def measure(self, top=50):
+        """Byte per guild e totali, misurati a blocchi per non bloccare l'event loop"""
+        sizes = []
+        for i, (guild_id, guild_data) in enumerate(list(guild_states.items())):
+            sizes.append((deep_size(guild_data), guild_id))
+            if i % GUILD_MEMORY_BATCH == GUILD_MEMORY_BATCH - 1:
+                await asyncio.sleep(0)
+        sizes.sort(reverse=True)
+        self.report = {
+            'guilds': len(sizes),
+            'guild_bytes': sum(size for size, _ in sizes),
+            'compacted_guilds': len(self.compacted),
+            'compacted_bytes': sum(sys.getsizeof(b) for b in self.compacted.values()),
+            'players': len(players),
+            'queue_views': len(active_queue_views),
+            'top': [{'guild_id': guild_id, 'bytes': size} for size, guild_id in sizes[:top]],
+        }
+        return self.report
 
-    except Exception as e:
-        print(f"[Music] Errore in play_next: {e}")
-        await play_next(guild, vc)
+    async def run(self):
+        last_report = 0
+        while True:
+            await asyncio.sleep(GUILD_SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+                if time.monotonic() - last_report >= GUILD_MEMORY_REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    await self.measure()
+            except Exception as e:
+                print(f"[Memory] Errore liberando le guild inattive: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+guild_memory = GuildMemory()
+
+# --- Caricamento in coda ---
+class QueueLoader:
+    """Aggiunge voci di yt-dlp alla coda di una guild e avvia la riproduzione alla prima traccia"""
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.queue = get_queue(interaction.guild.id)
+        self.added = 0
+        self.skipped = 0
+        self.truncated = False
+        self.playback_task = None
+
+    @property
+    def full(self):
+        return len(self.queue) >= QUEUE_LIMIT
+
+    async def start_playback(self):
+        # Connetti al voice channel appena c'è una traccia pronta, senza aspettare il resto
+        interaction = self.interaction
+        vc = await ensure_vc_connected(interaction.guild, interaction.user.voice.channel)
+        if vc is None:
+            return await interaction.followup.send("❌ Non sono riuscito a connettermi al canale vocale.", ephemeral=True)
+        if not vc.is_playing() and not vc.is_paused():
+            await play_next(interaction.guild, vc)
+        else:
+            schedule_prefetch(interaction.guild.id)
+
+    async def add(self, entry):
+        """Accoda una voce (saltando quelle non disponibili); False quando la coda è piena"""
+        if self.full:
+            self.truncated = True
+            return False
+        url = entry and (entry.get('webpage_url') or entry.get('url'))
+        # Nelle playlist flat i video rimossi o privati compaiono come "[Deleted video]" / "[Private video]"
+        if not url or entry.get('title') in UNAVAILABLE_TITLES:
+            self.skipped += 1
+            return True
+        track = Track(entry.get('title') or 'Sconosciuto', url, entry_thumbnail(entry), entry.get('duration'))
+        self.queue.append(track)
+        self.added += 1
+        if catalog:
+            catalog.record(entry)
+        await update_player_message(self.interaction.guild)
+        if self.playback_task is None:
+            self.playback_task = asyncio.create_task(self.start_playback())
+        return True
+
+    def summary(self):
+        if self.skipped:
+            metrics.inc('musicnow_skipped_tracks_total', self.skipped, reason='enqueue')
+        message = f"✅ Aggiunte {self.added} tracce alla coda. ⚠️ Skippate {self.skipped} tracce protette o non disponibili."
+        if self.truncated:
+            message += f" ⚠️ Coda piena ({QUEUE_LIMIT} tracce): il resto è stato ignorato."
+        return message
+
+    async def finish(self):
+        if self.playback_task:
+            await self.playback_task
 
 # --- Slash command ---
 @bot.tree.command(name="play", description="Cerca o riproduci musica da YouTube")
@@ -450,79 +2579,387 @@ async def play(interaction: discord.Interaction, query: str):
     if not interaction.user.voice or not interaction.user.voice.channel:
         return await interaction.followup.send("❌ Devi essere in un canale vocale!", ephemeral=True)
 
-    guild_queue = get_queue(interaction.guild.id)
-    if len(guild_queue) > 120:
+    loader = QueueLoader(interaction)
+    if loader.full:
         return await interaction.followup.send("⚠️ Coda troppo lunga.", ephemeral=True)
 
-    added = 0
-    skipped = 0
-    first_track_ready = asyncio.Event()
-
-    async def process_entry(entry):
-        nonlocal added, skipped
-        if not entry or 'url' not in entry:
-            skipped += 1
-            return
-        track = {
-            'title': entry.get('title', 'Sconosciuto'),
-            'url': entry.get('webpage_url'),
-            'thumbnail': entry.get('thumbnail')
-        }
-        guild_queue.append(track)
-        added += 1
-        await update_player_message(interaction.guild)
-        first_track_ready.set()  # Segnala che almeno una traccia è pronta
-
     try:
-        ydl_opts = {'format': 'bestaudio/best', 'quiet': True, 'ignoreerrors': True, 'geo_bypass': True}
-
         if query.startswith("http"):
-            loop = asyncio.get_event_loop()
-            def extract():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    return ydl.extract_info(query, download=False)
-            info = await loop.run_in_executor(None, extract)
-            entries = info.get('entries', [info])
-            await asyncio.gather(*(process_entry(entry) for entry in entries))
+            async with aclosing(resolver.iter_entries(query, guild_id=interaction.guild.id)) as entries:
+                async for entry in entries:
+                    if not await loader.add(entry):
+                        break
         else:
-            results = await search_youtube_yt_dlp(query)
+            # I metadati della ricerca flat bastano per la coda: lo stream si risolve al momento di suonare
+            results = await search_youtube_entries(query, interaction.guild.id, limit=1)
             if not results:
                 return await interaction.followup.send("❌ Nessun risultato trovato.", ephemeral=True)
-            first_url = results[0].value
-            loop = asyncio.get_event_loop()
-            def extract():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    return ydl.extract_info(first_url, download=False)
-            info = await loop.run_in_executor(None, extract)
-            await process_entry(info)
+            await loader.add(results[0])
 
     except Exception as e:
-        return await interaction.followup.send(f"❌ Errore caricando link o ricerca: {e}", ephemeral=True)
+        if not loader.added:
+            return await interaction.followup.send(f"❌ Errore caricando link o ricerca: {e}", ephemeral=True)
+        print(f"[Music] Playlist interrotta dopo {loader.added} tracce: {e}")
+
+    await interaction.followup.send(loader.summary(), ephemeral=True)
+    await loader.finish()
+
+# --- Aggiunta in blocco ---
+BULK_MAX_QUERIES = 200
+# Ricerche in parallelo per ogni /bulk; tutti i /bulk insieme ne hanno al massimo RESOLVER_BULK_WORKERS
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "4"))
+BULK_MAX_FILE_BYTES = 256 * 1024
+
+def parse_track_list(text):
+    """Elenco scritto nel comando: tracce separate da ';' o a capo. "artista,titolo" diventa
+    un'unica ricerca; i link restano link."""
+    queries = []
+    for line in text.replace(";", "\n").splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if not line.startswith("http") and "," in line:
+            line = " ".join(cell.strip().strip('"') for cell in line.split(",") if cell.strip())
+        queries.append(line)
+    return queries
+
+# Intestazioni riconosciute nei CSV (es. export di Spotify), in ordine di preferenza
+CSV_TITLE_COLUMNS = ("track name", "title", "titolo", "brano", "song", "track", "name", "nome")
+CSV_ARTIST_COLUMNS = ("artist", "artista", "autore", "author")
+CSV_LINK_COLUMNS = ("url", "link")
+
+def find_column(header, keywords):
+    for keyword in keywords:
+        for index, name in enumerate(header):
+            if keyword in name:
+                return index
+    return None
+
+def parse_track_file(text):
+    """File caricato con /bulk: testo con una traccia per riga oppure CSV (',', ';' o tab).
+
+    Dei CSV con intestazione si usano solo le colonne titolo/artista (o un link); senza
+    intestazione le prime due colonne, come "artista,titolo".
+    """
+    lines = [line for line in text.lstrip("\ufeff").splitlines() if line.strip() and not line.lstrip().startswith("#")]
+    if not lines:
+        return []
+    try:
+        dialect = csv.Sniffer().sniff("\n".join(lines[:20]), delimiters=",;\t")
+    except csv.Error:
+        return [line.strip() for line in lines]
+    rows = [[cell.strip() for cell in row] for row in csv.reader(lines, dialect)]
+    header = [name.lower() for name in rows[0]]
+    title = find_column(header, CSV_TITLE_COLUMNS)
+    artist = find_column(header, CSV_ARTIST_COLUMNS)
+    link = find_column(header, CSV_LINK_COLUMNS)
+    if title is None and artist is None and link is None:
+        title, artist = (1, 0) if len(header) > 1 else (0, None)
+    else:
+        rows = rows[1:]
+    queries = []
+    for row in rows:
+        cells = dict(enumerate(row))
+        url = next((c for c in row if c.startswith("http")), None) if link is None else cells.get(link, "")
+        if url and url.startswith("http"):
+            queries.append(url)
+            continue
+        query = " ".join(cells.get(i, "") for i in (artist, title) if i is not None).strip()
+        if query:
+            queries.append(query)
+    return queries
+
+async def lookup_bulk_entry(query, guild_id):
+    """Prima voce per una riga della lista: ricerca flat per il testo, enumerazione flat per i link"""
+    if query.startswith("http"):
+        async with aclosing(resolver.iter_entries(query, guild_id=guild_id)) as entries:
+            async for entry in entries:
+                return entry
+        return None
+    results = await search_youtube_entries(query, guild_id, limit=1, bulk=True)
+    return results[0] if results else None
 
-    await interaction.followup.send(f"✅ Aggiunte {added} tracce alla coda. ⚠️ Skippate {skipped} tracce protette o non disponibili.", ephemeral=True)
+@bot.tree.command(name="bulk", description="Aggiungi molte tracce insieme da un elenco o da un file .txt/.csv")
+@app_commands.describe(tracce="Titoli o link separati da ';'", file="File di testo o CSV con una traccia per riga")
+async def bulk(interaction: discord.Interaction, tracce: str = None, file: discord.Attachment = None):
+    await interaction.response.defer(ephemeral=True)
 
-    # Connetti al voice channel solo quando c’è una traccia pronta
-    await first_track_ready.wait()
-    vc = await ensure_vc_connected(interaction.guild, interaction.user.voice.channel)
-    if vc is None:
-        return await interaction.followup.send("❌ Non sono riuscito a connettermi al canale vocale.", ephemeral=True)
+    if not interaction.user.voice or not interaction.user.voice.channel:
+        return await interaction.followup.send("❌ Devi essere in un canale vocale!", ephemeral=True)
 
-    if not vc.is_playing():
-        await play_next(interaction.guild, vc)
+    queries = parse_track_list(tracce or "")
+    if file is not None:
+        if file.size > BULK_MAX_FILE_BYTES:
+            return await interaction.followup.send("⚠️ File troppo grande.", ephemeral=True)
+        queries += parse_track_file((await file.read()).decode("utf-8", errors="replace"))
+    queries = queries[:BULK_MAX_QUERIES]
+    if not queries:
+        return await interaction.followup.send("⚠️ Nessuna traccia nell'elenco.", ephemeral=True)
+
+    loader = QueueLoader(interaction)
+    if loader.full:
+        return await interaction.followup.send("⚠️ Coda troppo lunga.", ephemeral=True)
+
+    progress = await interaction.followup.send(f"🔎 Cerco {len(queries)} tracce...", ephemeral=True, wait=True)
+    done = 0
+    final = None
+
+    async def render_progress(_):
+        await progress.edit(content=final or f"🔎 Cercate {done}/{len(queries)} tracce, {loader.added} in coda...")
+
+    # Ricerche in parallelo, ma le tracce entrano in coda nell'ordine dell'elenco
+    results = [None] * len(queries)
+    ready = [asyncio.Event() for _ in queries]
+    slots = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def lookup(index, query):
+        nonlocal done
+        async with slots:
+            try:
+                results[index] = await lookup_bulk_entry(query, interaction.guild.id)
+            except Exception as e:
+                print(f"[Music] Ricerca fallita per {query!r}: {e}")
+        done += 1
+        ready[index].set()
+        render_scheduler.mark_dirty(('bulk', interaction.id), render_progress, None)
+
+    lookups = [asyncio.create_task(lookup(i, q)) for i, q in enumerate(queries)]
+    try:
+        for index in range(len(queries)):
+            await ready[index].wait()
+            if not await loader.add(results[index]):
+                break
+    finally:
+        for task in lookups:
+            task.cancel()
+
+    # Anche il riepilogo passa dallo scheduler, così nessun aggiornamento in ritardo lo sovrascrive
+    final = loader.summary()
+    render_scheduler.mark_dirty(('bulk', interaction.id), render_progress, None)
+    await loader.finish()
+
+
+def parse_timestamp(value):
+    """'90', '1:30' o '1:02:03' -> secondi"""
+    seconds = 0
+    for part in value.strip().split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+@bot.tree.command(name="seek", description="Salta a un punto della traccia corrente")
+@app_commands.describe(posizione="Secondi oppure mm:ss / hh:mm:ss")
+async def seek(interaction: discord.Interaction, posizione: str):
+    guild_data = get_guild_data(interaction.guild.id)
+    if guild_data['current_track'] is None:
+        return await interaction.response.send_message("❌ Nessuna musica in riproduzione.", ephemeral=True)
+    try:
+        seconds = parse_timestamp(posizione)
+    except ValueError:
+        return await interaction.response.send_message("⚠️ Posizione non valida: usa secondi o mm:ss.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    await get_player(interaction.guild).seek(seconds)
+    position = int(playback_position(guild_data))
+    await interaction.followup.send(f"⏩ Posizione: {position // 60}:{position % 60:02d}", ephemeral=True)
+
+@bot.tree.command(name="queue", description="Mostra la coda della guild")
+async def queue_command(interaction: discord.Interaction):
+    view = QueueView(interaction)
+    embed = view.build_embed()
+    await interaction.response.send_message(embed=embed, view=view)
+    view.message = await interaction.original_response()
+    view.signature = render_signature(embed, view)
 
 
 # --- Ready ---
+state_restored = False
+
+def command_tree_hash():
+    """Impronta delle definizioni degli slash command, per sapere se serve risincronizzarli"""
+    payload = sorted((c.to_dict(bot.tree) for c in bot.tree.get_commands()), key=lambda c: c['name'])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+async def sync_commands():
+    key = f"command_tree:{bot.application_id}"
+    digest = command_tree_hash()
+    if SYNC_COMMANDS != "force" and await state_store.get_meta(key) == digest:
+        print("🔗 Slash command invariati: sync saltato")
+        return
+    started = time.monotonic()
+    synced = await bot.tree.sync()
+    await state_store.set_meta(key, digest)
+    print(f"🔗 {len(synced)} slash command sincronizzati in {time.monotonic() - started:.2f}s")
+
 @bot.event
 async def on_ready():
+    global state_restored
     print(f"✅ Connesso come {bot.user}")
+    state_store.start()
+    guild_memory.start()
+    if state_restored:
+        return  # on_ready arriva anche a ogni riconnessione: il resto si fa una volta sola
+    state_restored = True
+    ready = time.monotonic() - STARTED_AT
+    metrics.set('musicnow_startup_seconds', ready)
+    print(f"⏱️ Pronto in {ready:.2f}s dall'avvio del processo")
+    asyncio.create_task(restore_state())
+    asyncio.create_task(resolver.warm_up())
+    if SYNC_COMMANDS == "0":
+        return
     try:
-        synced = await bot.tree.sync()
-        print(f"🔗 {len(synced)} slash command sincronizzati")
+        await sync_commands()
     except Exception as e:
         print(f"Errore sync: {e}")
 
+# --- Endpoint metriche ---
+EVENT_LOOP_PROBE_INTERVAL = 0.5
+
+@metrics.collector
+def collect_runtime():
+    samples = [
+        ('musicnow_voice_clients', 'gauge', {}, len(bot.voice_clients)),
+        ('musicnow_guild_states', 'gauge', {}, len(guild_states)),
+        ('musicnow_resolver_busy_workers', 'gauge', {}, resolver.busy),
+        ('musicnow_resolver_waiting', 'gauge', {}, resolver.waiting),
+        ('musicnow_resolver_saturation', 'gauge', {}, resolver.busy / resolver.workers),
+    ]
+    total = 0
+    for guild_id, guild_data in list(guild_states.items()):
+        length = len(guild_data['queue'])
+        total += length
+        if length:
+            samples.append(('musicnow_queue_length', 'gauge', {'guild': guild_id}, length))
+    samples.append(('musicnow_queued_tracks', 'gauge', {}, total))
+    for name, value in list(track_cache.stats.items()):
+        samples.append((f'musicnow_track_cache_{name}_total', 'counter', {}, value))
+    report = guild_memory.report
+    if report:
+        samples.append(('musicnow_guild_state_bytes', 'gauge', {}, report['guild_bytes']))
+        samples.append(('musicnow_compacted_guild_bytes', 'gauge', {}, report['compacted_bytes']))
+    samples.append(('musicnow_compacted_guilds', 'gauge', {}, len(guild_memory.compacted)))
+    pipelines, listeners = shared_streams.stats()
+    samples.append(('musicnow_shared_pipelines', 'gauge', {}, pipelines))
+    samples.append(('musicnow_shared_listeners', 'gauge', {}, listeners))
+    return samples
+
+async def monitor_event_loop():
+    """Misura di quanto l'event loop arriva in ritardo rispetto a uno sleep programmato"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_PROBE_INTERVAL)
+        lag = max(0.0, loop.time() - start - EVENT_LOOP_PROBE_INTERVAL)
+        metrics.set('musicnow_event_loop_lag_seconds', lag)
+        metrics.observe('musicnow_event_loop_lag_histogram_seconds', lag)
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve /metrics con Flask in un thread separato"""
+    from flask import Flask, Response
+    from werkzeug.serving import make_server
+
+    app = Flask("musicnow-metrics")
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.route("/memory")
+    def memory_endpoint():
+        # Ultima misura fatta dal loop (ogni GUILD_MEMORY_REPORT_INTERVAL): qui non si ricalcola
+        return Response(json.dumps(guild_memory.report, indent=2), mimetype="application/json")
+
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"📈 Metriche su http://{host}:{port}/metrics")
+    return server
+
 async def main():
-    await bot.start(TOKEN)
+    global audio_cache
+    if AUDIO_CACHE_ENABLED:
+        audio_cache = AudioCache()
+    if METRICS_PORT:
+        start_metrics_server()
+    lag_monitor = asyncio.create_task(monitor_event_loop())
+    # Il launcher ferma i worker con SIGTERM: chiudere il bot fa girare il finally qui sotto
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+    try:
+        await bot.start(TOKEN)
+    finally:
+        lag_monitor.cancel()
+        await state_store.flush()
+        if catalog:
+            await catalog.flush()
+
+# --- Launcher multi-processo ---
+WORKER_RESTART_MAX_DELAY = 60
+WORKER_STABLE_AFTER = 120  # dopo quanti secondi di vita un worker non è più "in crash loop"
+
+def worker_env(index, shard_ids, shard_count):
+    """Ambiente di un worker: i suoi shard, una porta metriche e una cache audio tutta sua"""
+    env = dict(os.environ)
+    env.update(SHARD_COUNT=str(shard_count), SHARD_IDS=",".join(map(str, shard_ids)))
+    # Un solo processo registra gli slash command: sono globali, non per shard
+    env['SYNC_COMMANDS'] = "1" if index == 0 else "0"
+    if METRICS_PORT:
+        env['METRICS_PORT'] = str(METRICS_PORT + index)
+    # index.json della cache audio è di un solo processo: ogni worker ha la sua cartella,
+    # accanto a quella principale (dentro verrebbe presa per un file orfano)
+    env['AUDIO_CACHE_DIR'] = f"{AUDIO_CACHE_DIR}-worker-{index}"
+    return env
+
+def run_launcher(shard_count, processes):
+    """Avvia `processes` worker, ognuno con una parte degli shard, e riavvia solo quelli che cadono"""
+    groups = [list(range(shard_count))[i::processes] for i in range(processes)]
+    groups = [g for g in groups if g]
+    workers = {}  # indice -> [processo, avviato alle, ritardo di riavvio, riavvio alle]
+    stopping = False
+
+    def spawn(index):
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=worker_env(index, groups[index], shard_count))
+        print(f"🚀 Worker {index} (pid {proc.pid}) shard {groups[index]}")
+        return proc
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(len(groups)):
+        workers[index] = [spawn(index), time.monotonic(), 1, None]
+
+    while not stopping:
+        time.sleep(1)
+        now = time.monotonic()
+        for index, worker in workers.items():
+            proc, started, delay, restart_at = worker
+            if restart_at is not None:
+                if now >= restart_at:
+                    worker[0], worker[1], worker[3] = spawn(index), now, None
+                continue
+            code = proc.poll()
+            if code is None:
+                continue
+            # Backoff esponenziale solo se il worker muore subito dopo l'avvio
+            delay = 1 if now - started > WORKER_STABLE_AFTER else min(delay * 2, WORKER_RESTART_MAX_DELAY)
+            print(f"⚠️ Worker {index} uscito con codice {code}: riavvio tra {delay}s")
+            worker[2], worker[3] = delay, now + delay
+
+    for proc, *_ in workers.values():
+        if proc.poll() is None:
+            proc.terminate()
+    for proc, *_ in workers.values():
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
 
 # Avvia tutto
-asyncio.run(main())
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MusicNow")
+    parser.add_argument("--shards", type=int, default=0, help="numero totale di shard (attiva il launcher multi-processo)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="processi worker tra cui dividere gli shard")
+    cli = parser.parse_args()
+    if cli.shards:
+        run_launcher(cli.shards, min(cli.processes, cli.shards))
+    else:
+        asyncio.run(main())